@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+
+"""
+Aggregates of the test results per task and per view.
+
+The sums are kept up to date by save_user_data() as tasks finish, and the
+median times are read from the middle of an index of the finished tasks'
+times, so neither finishing a task nor reading them scans all tasks. They
+can also be rebuilt from scratch from the tasks table.
+"""
+
+from collections import OrderedDict
+from user_data import (
+        SUCCESS_SQL,
+        TIME_ELAPSED_SQL,
+        get_connection)
+import argparse
+import json
+import numpy as np
+
+def median_time(connection, column, key):
+    """Returns the median time of the finished tasks with a given id or view.
+
+    Only tasks with a time are counted, the same ones that _add_to_analytics()
+    and rebuild_analytics() count as completed.
+
+    Args:
+        column: "id" or "view".
+        key: Value of the column.
+    """
+    condition = "finished = 1 AND %s = ? AND elapsed IS NOT NULL" % column
+    count, = connection.execute("SELECT COUNT(*) FROM tasks WHERE %s" %
+            condition, (key,)).fetchone()
+    times = [row[0] for row in connection.execute("""SELECT elapsed FROM tasks
+        WHERE %s ORDER BY elapsed LIMIT ? OFFSET ?""" % condition,
+        (key, 2 - count % 2, (count - 1) // 2))]
+    return sum(times) / len(times) if times else None
+
+def get_analytics():
+    """Returns the aggregates grouped by task id and by view.
+
+    Returns:
+        A dictionary with the lists "tasks" and "views", holding one
+        dictionary of aggregates per task id or view.
+    """
+    connection = get_connection()
+    out = OrderedDict((("tasks", []), ("views", [])))
+    for grouping, key, completed, successes, clicks, total_time in \
+            connection.execute("""SELECT grouping, key, completed, successes,
+            clicks, total_time FROM analytics ORDER BY grouping,
+            CAST(key AS INTEGER), key""").fetchall():
+        if grouping == "task":
+            key = int(key)
+            median = median_time(connection, "id", key)
+        else:
+            median = median_time(connection, "view", key)
+        out["tasks" if grouping == "task" else "views"].append(OrderedDict((
+            ("task_id" if grouping == "task" else "view", key),
+            ("completed", completed),
+            ("success_rate", successes / completed),
+            ("median_time", median),
+            ("mean_time", total_time / completed),
+            ("mean_clicks", clicks / completed),
+        )))
+    return out
+
+def group_aggregates(keys, success, clicks, times):
+    """Computes the aggregates of each distinct key.
+
+    Args:
+        keys: Array with the group of each finished task.
+        success, clicks, times: Arrays with the outcome of each task.
+
+    Returns:
+        A list of (key, completed, successes, clicks, total_time) tuples.
+    """
+    groups, inverse = np.unique(keys, return_inverse=True)
+    return list(zip(groups.tolist(), np.bincount(inverse).tolist(),
+        np.bincount(inverse, weights=success).astype(int).tolist(),
+        np.bincount(inverse, weights=clicks).astype(int).tolist(),
+        np.bincount(inverse, weights=times).tolist()))
+
+def rebuild_analytics():
+    """Recomputes all aggregates from the finished tasks.
+
+    Returns:
+        The number of finished tasks.
+    """
+    connection = get_connection()
+    with connection:
+        connection.execute("UPDATE tasks SET elapsed = %s WHERE finished = 1"
+                % TIME_ELAPSED_SQL)
+        rows = connection.execute("""SELECT id, view, %s, clicks, elapsed
+            FROM tasks WHERE finished = 1""" % SUCCESS_SQL).fetchall()
+
+        connection.execute("DELETE FROM analytics")
+        if not rows:
+            return 0
+
+        task_ids, views, success, clicks, times = zip(*rows)
+        success = np.array(success, dtype=float)
+        clicks = np.array(clicks, dtype=float)
+        times = np.array(times, dtype=float)
+
+        for grouping, keys in (("task", np.array(task_ids)),
+                ("view", np.array(views))):
+            connection.executemany("""INSERT INTO analytics (grouping, key,
+                completed, successes, clicks, total_time) VALUES
+                (?, ?, ?, ?, ?, ?)""", ((grouping, str(key)) + tuple(rest)
+                    for key, *rest in group_aggregates(keys, success, clicks,
+                        times)))
+
+    return len(rows)
+
+def main():
+    p = argparse.ArgumentParser(description="Prints the test analytics.")
+    p.add_argument("--rebuild", default=False, action="store_true",
+        help="Recompute the aggregates from all finished tasks first.")
+    opts = p.parse_args()
+
+    if opts.rebuild:
+        print("Rebuilt analytics from %d finished tasks" % rebuild_analytics())
+
+    print(json.dumps(get_analytics(), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks a search engine on synthetic ontology corpora of growing size.
+
+For each corpus size, a CSV file in the format of corpora/ontology.csv is
+generated, indexed and queried. Each size runs in a separate process, so
+that its peak memory use can be measured. The results are written as JSON,
+which can be compared across commits.
+
+    $ python3 benchmarks/bench_engine.py --sizes 1000,10000 -o bench.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import search # local
+
+def make_words(rng, count):
+    """Returns a list of distinct, pronounceable made up words."""
+    consonants = "bcdfghjklmnprstvz"
+    vowels = "aeiou"
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels)
+            for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def generate_corpus(filename, rows, seed=0):
+    """Writes a synthetic ontology CSV file.
+
+    Categories form a tree with a branching factor of about 10 and a depth
+    of 2 to 4 levels, and names and descriptions are drawn from a vocabulary
+    that grows with the number of rows.
+
+    Returns:
+        The vocabulary.
+    """
+    rng = random.Random(seed)
+    words = make_words(rng, max(100, int(rows ** 0.5) * 10))
+
+    def phrase(low, high):
+        return " ".join(rng.choice(words).capitalize()
+                for _ in range(rng.randint(low, high)))
+
+    roots = [phrase(1, 2) for _ in range(10)]
+    categories = []
+    for _ in range(max(10, rows // 20)):
+        path = [rng.choice(roots)]
+        for _ in range(rng.randint(1, 3)):
+            path.append("%s %d" % (phrase(1, 2), rng.randint(1, 10)))
+        categories.append("; ".join(path))
+
+    with open(filename, "wt") as f:
+        f.write("#category, link, name, description\n")
+        for i in range(rows):
+            f.write("%s,http://www.wikidata.org/entity/Q%d,%s,%s\n" % (
+                rng.choice(categories), i + 1, phrase(1, 3),
+                phrase(3, 8).lower()))
+
+    return words
+
+def percentiles(samples):
+    """Returns a summary of timings in milliseconds."""
+    samples = sorted(samples)
+
+    def rank(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "mean_ms": 1000 * sum(samples) / len(samples),
+        "p50_ms": 1000 * rank(50),
+        "p95_ms": 1000 * rank(95),
+        "p99_ms": 1000 * rank(99),
+    }
+
+def time_calls(function, arguments):
+    samples = []
+    for argument in arguments:
+        started = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+def run_size(opts, rows, directory):
+    """Benchmarks one corpus size, returning a dictionary of results."""
+    path = os.path.join(directory, "synthetic")
+    index = os.path.join(directory, "index")
+    words = generate_corpus(path + ".csv", rows, seed=opts.seed)
+    rng = random.Random(opts.seed + 1)
+
+    result = {"rows": rows}
+
+    Engine = search.get_engines()[opts.engine]
+    started = time.perf_counter()
+    if hasattr(Engine, "build"):
+        Engine.build(path, index, procs=opts.procs)
+    engine = search.get_engine(opts.engine, path, index,
+            cache_size=opts.cache_size)
+    result["build_seconds"] = time.perf_counter() - started
+    result["build_rows_per_second"] = rows / result["build_seconds"]
+
+    # The first calls build in-memory structures
+    started = time.perf_counter()
+    engine.category_tree()
+    result["category_tree_cold_ms"] = 1000 * (time.perf_counter() - started)
+    started = time.perf_counter()
+    engine.suggest("a")
+    result["suggest_cold_ms"] = 1000 * (time.perf_counter() - started)
+
+    queries = [" ".join(rng.sample(words, rng.randint(1, 2)))
+            for _ in range(opts.queries)]
+    prefixes = [rng.choice(words)[:rng.randint(2, 4)]
+            for _ in range(opts.queries)]
+    links = ["http://www.wikidata.org/entity/Q%d" % rng.randint(1, rows)
+            for _ in range(opts.queries)]
+
+    result["operations"] = {
+        "search": time_calls(lambda q: list(engine.search(q)), queries),
+        "suggest": time_calls(engine.suggest, prefixes),
+        "select": time_calls(engine.select, links),
+        "category_tree": time_calls(lambda _: engine.category_tree(),
+            range(opts.queries)),
+    }
+
+    if hasattr(engine, "search_page"):
+        result["operations"]["search_page"] = time_calls(
+                engine.search_page, queries)
+
+    # Kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        maxrss *= 1024
+    result["peak_rss_mb"] = maxrss / 2**20
+    return result
+
+def _run_size_in_tempdir(opts, rows, results):
+    # Keeps the engine's progress messages out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        with search.tempdir() as directory:
+            results.put(run_size(opts, rows, directory))
+
+def run_size_in_process(opts, rows):
+    """Runs run_size() in a new process, so peak memory isn't shared."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_size_in_tempdir,
+            args=(opts, rows, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmarks a search engine "
+            "on synthetic ontology corpora.")
+
+    p.add_argument("--engine", "-e", type=str, default="whoosh",
+        help="Search engine to use, one of: %s" % " ".join(
+            search.get_engines()))
+
+    p.add_argument("--sizes", type=str, default="1000,10000,100000",
+        help="Comma separated corpus sizes in rows, e.g. 1000,1000000.")
+
+    p.add_argument("--queries", type=int, default=200,
+        help="Number of calls timed for each operation.")
+
+    p.add_argument("--procs", type=int, default=1,
+        help="Number of processes used to build the index.")
+
+    p.add_argument("--cache-size", type=int, default=0,
+        help="Size of the engine's query cache, disabled by default.")
+
+    p.add_argument("--seed", type=int, default=0,
+        help="Seed of the corpus and query generator.")
+
+    p.add_argument("--output", "-o", type=str, default=None,
+        help="Write the JSON results to this file instead of stdout.")
+
+    return p.parse_args()
+
+def main():
+    opts = parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "engine": opts.engine,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "queries": opts.queries,
+        "results": [],
+    }
+
+    for rows in [int(size) for size in opts.sizes.split(",")]:
+        print("Benchmarking %s with %d rows" % (opts.engine, rows),
+                file=sys.stderr)
+        report["results"].append(run_size_in_process(opts, rows))
+
+    output = json.dumps(report, indent=2)
+    if opts.output is None:
+        print(output)
+    else:
+        with open(opts.output, "wt") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
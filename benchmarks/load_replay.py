@@ -0,0 +1,334 @@
+#! /usr/bin/env python3
+
+"""
+Replays study sessions of many concurrent users against the web app.
+
+Each simulated user logs in and works through its tasks from
+get_test_tasks() like a participant would: browsing the navigation menu,
+typing into the autocompletion box, searching, opening a result and
+completing the task, posting interaction statistics along the way. Requests
+go either to a SearchApp through the Flask test client, or to a running
+server with --url.
+
+Afterwards, the exported test results are compared with what the users
+sent, to detect lost user data writes.
+
+    $ python3 benchmarks/load_replay.py --users 50
+    $ python3 benchmarks/load_replay.py --users 50 --url http://localhost:8080
+"""
+
+from collections import defaultdict
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import http.cookiejar
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import search # local
+from event_log import get_event_log # local
+from user_data import get_test_tasks # local
+
+class TestClientSession():
+    """Sends requests to an app through a Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, params=None, data=None):
+        if method == "GET":
+            response = self.client.get(path, query_string=params)
+        else:
+            response = self.client.post(path, data=data)
+        return response.status_code, response.get_data()
+
+class HttpSession():
+    """Sends requests to a running server, keeping its cookies."""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kw):
+            return None
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(
+                    http.cookiejar.CookieJar()),
+                self.NoRedirect)
+
+    def request(self, method, path, params=None, data=None):
+        url = self.url + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params, doseq=True)
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data).encode("utf-8")
+        try:
+            with self.opener.open(urllib.request.Request(url, data=body,
+                method=method), timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            # Includes the redirects, which aren't followed
+            return e.code, e.read()
+
+class Recorder():
+    """Collects the latencies and errors of requests per route."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, session, route, method, path, **kw):
+        started = time.perf_counter()
+        try:
+            status, body = session.request(method, path, **kw)
+        except Exception as e:
+            status, body = None, str(e).encode("utf-8")
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            if status is None or status >= 400:
+                self.errors[route] += 1
+        return status, body
+
+class SimulatedUser():
+    def __init__(self, userid, session, recorder, rng, opts):
+        self.userid = userid
+        self.session = session
+        self.recorder = recorder
+        self.rng = rng
+        self.opts = opts
+        self.timestamp = 0.0
+        # Number of events sent per task position
+        self.clicks = defaultdict(int)
+
+    def pause(self):
+        if self.opts.think_time > 0:
+            time.sleep(self.rng.expovariate(1 / self.opts.think_time))
+
+    def events(self, position):
+        """Returns a JSON list of made up interaction events."""
+        events = []
+        for _ in range(self.rng.randint(1, 5)):
+            self.timestamp += self.rng.uniform(50, 2000)
+            events.append({
+                "type": self.rng.choice(("mousedown", "keypress")),
+                "link": "",
+                "x_pos": self.rng.randint(0, 1200),
+                "y_pos": self.rng.randint(0, 900),
+                "timestamp": self.timestamp,
+                "key": "",
+            })
+        self.clicks[position] += len(events)
+        return json.dumps(events)
+
+    def request(self, route, method, path=None, **kw):
+        self.pause()
+        return self.recorder.request(self.session, route, method,
+                path or route, **kw)
+
+    def run(self):
+        self.request("/login", "POST", data={"userid": self.userid})
+
+        tasks = get_test_tasks(self.userid)[:self.opts.tasks]
+        for position, task in enumerate(tasks):
+            words = sorted(re.findall(r"\w{4,}", task.text), key=len,
+                    reverse=True)[:2] or ["the"]
+            query = " ".join(words)
+
+            if task.view == "navigation":
+                self.request("/search/navigation", "GET")
+                path = []
+                for _ in range(self.rng.randint(1, 3)):
+                    status, body = self.request("/search/navigation/children",
+                            "GET", params={"path": path})
+                    try:
+                        children = [c for c in json.loads(body)["children"]
+                                if "count" in c]
+                    except (ValueError, KeyError):
+                        break
+                    if not children:
+                        break
+                    path.append(self.rng.choice(children)["name"])
+            elif task.view == "search":
+                self.request("/search/freetext", "POST", data={
+                    "query": query, "stats": self.events(position)})
+            else:
+                for end in range(2, len(words[0]) + 1):
+                    self.request("/autocomplete", "GET",
+                            params={"query": words[0][:end]})
+                self.request("/search/suggestions", "POST", data={
+                    "query": query, "stats": self.events(position)})
+
+            # Most participants find the right answer
+            link = task.link if self.rng.random() < 0.7 else "abort"
+            self.request("/search/results", "POST", data={"link": link,
+                "stats": self.events(position)})
+            self.request("/search/finalizer", "GET")
+
+def check_results(session, users, tasks):
+    """Compares the exported results with what the users sent.
+
+    Returns:
+        A list of error messages about lost or corrupted writes.
+    """
+    status, body = session.request("GET", "/export")
+    if status != 200:
+        return ["Could not export results: HTTP %s" % status]
+
+    exported = {}
+    for row in csv.DictReader(io.StringIO(body.decode("utf-8"))):
+        exported[(row["userid"], int(row["index"]))] = row
+
+    errors = []
+    for user in users:
+        for position in range(tasks):
+            row = exported.get((user.userid, position))
+            if row is None:
+                errors.append("%s: task %d is missing" % (user.userid,
+                    position))
+                continue
+            if int(row["clicks"]) != user.clicks[position]:
+                errors.append("%s: task %d has %s clicks, sent %d" % (
+                    user.userid, position, row["clicks"],
+                    user.clicks[position]))
+            if row["completed"] != "True":
+                errors.append("%s: task %d was not completed" % (user.userid,
+                    position))
+    return errors
+
+def summarize(recorder, seconds):
+    """Returns the throughput and latency percentiles per route."""
+
+    def rank(samples, p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    routes = {}
+    for route, samples in sorted(recorder.latencies.items()):
+        samples = sorted(samples)
+        routes[route] = {
+            "requests": len(samples),
+            "errors": recorder.errors[route],
+            "p50_ms": 1000 * rank(samples, 50),
+            "p95_ms": 1000 * rank(samples, 95),
+            "p99_ms": 1000 * rank(samples, 99),
+            "max_ms": 1000 * samples[-1],
+        }
+
+    requests = sum(r["requests"] for r in routes.values())
+    return {
+        "seconds": seconds,
+        "requests": requests,
+        "requests_per_second": requests / seconds,
+        "routes": routes,
+    }
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Replays concurrent study "
+            "sessions against the web app.")
+
+    p.add_argument("--users", "-n", type=int, default=20,
+        help="Number of concurrent simulated users.")
+
+    p.add_argument("--tasks", type=int, default=15,
+        help="Number of tasks each user works through.")
+
+    p.add_argument("--think-time", type=float, default=0,
+        help="Mean number of seconds users wait between requests.")
+
+    p.add_argument("--url", type=str, default=None,
+        help="URL of a running server, instead of using a test client.")
+
+    p.add_argument("--corpus", type=str, default="ontology",
+        help="Corpus of the test client app.")
+
+    p.add_argument("--engine", type=str, default="whoosh",
+        help="Search engine of the test client app.")
+
+    p.add_argument("--seed", type=int, default=None,
+        help="Seed of the simulated users' choices.")
+
+    p.add_argument("--output", "-o", type=str, default=None,
+        help="Also write the JSON report to this file.")
+
+    return p.parse_args()
+
+def run(opts, new_session):
+    recorder = Recorder()
+    rng = random.Random(opts.seed)
+    run_id = "%x" % rng.getrandbits(32)
+    users = [SimulatedUser("load-%s-%d" % (run_id, i), new_session(),
+        recorder, random.Random(rng.getrandbits(32)), opts)
+        for i in range(opts.users)]
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(opts.users) as executor:
+        for future in [executor.submit(user.run) for user in users]:
+            future.result()
+    report = summarize(recorder, time.perf_counter() - started)
+
+    report["users"] = opts.users
+    report["lost_writes"] = check_results(new_session(), users,
+            min(opts.tasks, 15))
+    return report
+
+def main():
+    opts = parse_args()
+
+    if opts.url is not None:
+        report = run(opts, lambda: HttpSession(opts.url))
+    else:
+        import server # local
+
+        # The app keeps user data relative to the working directory, so the
+        # simulated users are kept out of the real data
+        with search.tempdir() as directory:
+            os.mkdir(os.path.join(directory, "user_data"))
+            with contextlib.redirect_stdout(sys.stderr):
+                app = server.SearchApp("server", search_engine_name=opts.engine,
+                        corpus=opts.corpus,
+                        template_folder=os.path.join(ROOT, "templates"))
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                report = run(opts, lambda: TestClientSession(app))
+            finally:
+                # Queued events are written relative to the working directory
+                get_event_log().flush()
+                os.chdir(cwd)
+
+    print("%d users, %d requests in %.2fs (%.1f requests/s)" % (
+        report["users"], report["requests"], report["seconds"],
+        report["requests_per_second"]))
+    print("%-30s %8s %7s %9s %9s %9s" % ("route", "requests", "errors",
+        "p50 ms", "p95 ms", "p99 ms"))
+    for route, r in report["routes"].items():
+        print("%-30s %8d %7d %9.1f %9.1f %9.1f" % (route, r["requests"],
+            r["errors"], r["p50_ms"], r["p95_ms"], r["p99_ms"]))
+    print("%d lost or corrupted writes" % len(report["lost_writes"]))
+    for error in report["lost_writes"][:20]:
+        print("  " + error)
+
+    if opts.output is not None:
+        with open(opts.output, "wt") as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(1 if report["lost_writes"] else 0)
+
+if __name__ == "__main__":
+    main()
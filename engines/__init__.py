@@ -1,5 +1,7 @@
+from .memory import MemorySearchEngine
 from .whoosh import WhooshSearchEngine
 
 __all__ = (
+    "MemorySearchEngine",
     "WhooshSearchEngine",
 )
@@ -0,0 +1,122 @@
+"""
+Caches query results in the search engines.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+class Flight():
+    """A computation in progress, which other threads can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class QueryCache():
+    """A thread-safe, least recently used cache with a time to live.
+
+    Entries belong to a version of the index. Asking for an entry of another
+    version empties the cache, so results never outlive the index they were
+    computed from.
+
+    Concurrent misses of the same key are coalesced: the first thread
+    computes the value and the others wait for it, even when caching is
+    disabled.
+    """
+
+    def __init__(self, size=1024, ttl=300):
+        """Initializes the cache.
+
+        Args:
+            size: Maximum number of entries, or 0 to disable caching.
+            ttl: Number of seconds an entry is valid, or None for no limit.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.version = None
+        self.entries = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version, compute):
+        """Returns the cached value for key, or computes and caches it.
+
+        Args:
+            key: Hashable key of the query.
+            version: Version of the index the value is computed from.
+            compute: Function without arguments that returns the value.
+        """
+        now = time.time()
+        with self.lock:
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.version = version
+
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or
+                    now - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self.flights.get((version, key))
+            leader = flight is None
+            if leader:
+                flight = self.flights[(version, key)] = Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.result()
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[(version, key)]
+                if flight.error is None and self.size > 0 and \
+                        version == self.version:
+                    self.entries[key] = (now, flight.value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of the cache counters."""
+        with self.lock:
+            return OrderedDict((
+                ("size", len(self.entries)),
+                ("capacity", self.size),
+                ("hits", self.hits),
+                ("misses", self.misses),
+                ("coalesced", self.coalesced),
+                ("in_flight", len(self.flights)),
+                ("evictions", self.evictions),
+                ("invalidations", self.invalidations),
+            ))
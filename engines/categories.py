@@ -0,0 +1,86 @@
+"""
+Builds and persists the category tree used for menu navigation.
+
+The tree is computed once per index generation and saved next to the index,
+so that serving the navigation view doesn't require a scan of every stored
+document.
+"""
+
+from collections import OrderedDict
+from natsort import natsorted
+import json
+import os
+
+FILENAME = "categories.json"
+
+def build_tree(records):
+    """Returns a naturally sorted, nested category tree.
+
+    Args:
+        records: Iterable of (category, name, link) tuples, where category is
+            a comma separated path of category names.
+    """
+    out = dict()
+
+    for category, name, link in records:
+        current = out
+        for cat in category.split(","):
+            if cat not in current:
+                current[cat] = {}
+            current = current[cat]
+
+        current[name] = link
+
+    def sortOD(od):
+        res = OrderedDict()
+        for k, v in natsorted(od.items()):
+            if isinstance(v, dict):
+                res[k] = sortOD(v)
+            else:
+                res[k] = v
+        return res
+
+    return sortOD(out)
+
+def load_tree(index, version):
+    """Returns the tree saved for the given index version, or None."""
+    try:
+        with open(os.path.join(index, FILENAME), "rt") as f:
+            data = json.load(f, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return None
+
+    if data.get("version") != version:
+        return None
+    return data["tree"]
+
+def save_tree(index, version, tree):
+    """Atomically saves the tree for the given index version."""
+    filename = os.path.join(index, FILENAME)
+    temporary = "%s.%d.tmp" % (filename, os.getpid())
+    with open(temporary, "wt") as f:
+        json.dump({"version": version, "tree": tree}, f,
+                separators=(",", ":"))
+    os.replace(temporary, filename)
+
+def children(tree, path):
+    """Returns one level of the category tree.
+
+    Args:
+        tree: Tree as returned by build_tree().
+        path: List of category names leading to the level.
+
+    Returns:
+        A list of (name, value) tuples, where value is either the link of a
+        document or the number of children of a subcategory.
+
+    Raises:
+        KeyError: If the path does not lead to a category.
+    """
+    node = tree
+    for name in path:
+        node = node[name]
+        if not isinstance(node, dict):
+            raise KeyError(name)
+
+    return [(k, v if isinstance(v, str) else len(v)) for k, v in node.items()]
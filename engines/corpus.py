@@ -0,0 +1,174 @@
+"""
+Reads the documents of corpora, either ontology CSV files or directories of
+text files.
+"""
+
+from collections import Counter
+from urllib.parse import quote
+import codecs
+import functools
+import hashlib
+import multiprocessing
+import os
+import re
+
+# Number of bytes read from a text file at a time
+CHUNK_SIZE = 1 << 16
+
+# Number of characters of a text file shown as its description
+DESCRIPTION_LENGTH = 200
+
+def fingerprint(name, link, category, description):
+    """Returns a digest of a CSV row, used to detect changed rows."""
+    row = "\x00".join((name, link, category, description))
+    return hashlib.sha1(row.encode("utf-8")).hexdigest()
+
+def read_csv(filename):
+    """Yields a document dictionary for each row in an ontology CSV file."""
+    # TODO: Use the "csv" module for reading these files
+    with open(filename) as file:
+        for line_number, line in enumerate(file, 1):
+            if line.startswith("#"):
+                # Skip comments or header fields
+                continue
+
+            line = line.rstrip() # removes trailiing CRLF
+            fields = line.split(",")
+
+            try:
+                name = fields[2]
+                category = ",".join(fields[0].split(";"))
+                link = fields[1]
+            except IndexError as error:
+                print("%s:%d: %s: %r" % (os.path.basename(filename),
+                    line_number, error, line))
+                raise RuntimeError("The CSV file seems to be invalid."
+                        + " Check for proper use of separators.") from error
+
+            try:
+                # In the CSV file, it seems that the description is
+                # optional
+                description = fields[3]
+            except IndexError:
+                print("%s:%d: warning: missing description: %r" %
+                        (os.path.basename(filename), line_number,
+                            line))
+                description = ""
+
+            yield dict(
+                name=name,
+                link=link,
+                category=category,
+                description=description,
+                fingerprint=fingerprint(name, link, category, description))
+
+def is_directory(path):
+    """Returns whether a corpus is a directory of text files, rather than an
+    ontology CSV file."""
+    return not os.path.exists(path + ".csv") and os.path.isdir(path)
+
+def list_documents(path):
+    """Yields the paths of the files under a directory, relative to it, in
+    sorted order. Hidden files and directories are skipped."""
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.startswith("."):
+                yield os.path.relpath(os.path.join(root, name), path)
+
+def title_and_description(head, default):
+    """Returns the title and description of a text file from its first
+    characters.
+
+    The title is the first non-empty line, or the page name of the "%%#PAGE"
+    header in the Yahoo! Webscope files.
+    """
+    lines = [line.strip() for line in head.splitlines()]
+    lines = [line for line in lines if line]
+    for line in lines:
+        if line.startswith("%%#PAGE"):
+            title = line[len("%%#PAGE"):].strip().replace("_", " ")
+            return title or default, ""
+    if not lines:
+        return default, ""
+    description = " ".join(" ".join(lines[1:]).split())
+    if len(description) > DESCRIPTION_LENGTH:
+        description = description[:DESCRIPTION_LENGTH].rsplit(" ", 1)[0] + \
+                "..."
+    return lines[0][:DESCRIPTION_LENGTH], description
+
+def read_document(path, relpath, analyzer, chunk_size=CHUNK_SIZE):
+    """Reads and analyzes one text file, a chunk at a time.
+
+    Only the counts of the analyzed words are kept, so memory use doesn't
+    grow with the size of the file.
+
+    Args:
+        path: Path to the corpus directory.
+        relpath: Path of the file, relative to the corpus directory.
+        analyzer: Whoosh analyzer of the body field.
+        chunk_size: Number of bytes read at a time.
+
+    Returns:
+        A document dictionary, with the word counts as body.
+    """
+    digest = hashlib.sha1()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    counts = Counter()
+    head = ""
+    rest = ""
+
+    def analyze(text):
+        counts.update(token.text for token in analyzer(text))
+
+    with open(os.path.join(path, relpath), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+            text = decoder.decode(chunk)
+            if len(head) < 4 * DESCRIPTION_LENGTH:
+                head += text[:4 * DESCRIPTION_LENGTH - len(head)]
+            text = rest + text
+            # A word cut at the end of the chunk is analyzed with the next
+            # one, unless it's longer than a whole chunk
+            rest = re.search(r"\S*\Z", text).group()
+            if len(rest) < chunk_size:
+                text = text[:len(text) - len(rest)]
+            else:
+                rest = ""
+            analyze(text)
+    analyze(rest + decoder.decode(b"", final=True))
+
+    relpath = relpath.replace(os.sep, "/")
+    directory = os.path.dirname(relpath)
+    title, description = title_and_description(head,
+            os.path.basename(relpath))
+    return dict(
+        name=title,
+        link="/doc/" + quote(relpath),
+        # Files are categorized by their directories, under the corpus name
+        category=",".join([os.path.basename(os.path.abspath(path))] +
+            (directory.split("/") if directory else [])),
+        description=description,
+        fingerprint=digest.hexdigest(),
+        body=counts)
+
+def read_directory(path, analyzer, procs=1, chunk_size=CHUNK_SIZE):
+    """Yields a document dictionary for each text file under a directory.
+
+    With several processes, files are read and analyzed in parallel, and
+    yielded in the same order.
+
+    Args:
+        path: Path to the corpus directory.
+        analyzer: Whoosh analyzer of the body field.
+        procs: Number of processes reading files.
+        chunk_size: Number of bytes read from a file at a time.
+    """
+    read = functools.partial(read_document, path, analyzer=analyzer,
+            chunk_size=chunk_size)
+    if procs <= 1:
+        yield from map(read, list_documents(path))
+        return
+
+    with multiprocessing.Pool(procs) as pool:
+        yield from pool.imap(read, list_documents(path), chunksize=8)
@@ -0,0 +1,142 @@
+"""
+A read-only, memory-mapped columnar store of the documents' fields.
+
+Each field is kept as one UTF-8 blob with an array of offsets into it, so
+the value of a field of document n is blob[offsets[n]:offsets[n + 1]].
+Reading a value only decodes those bytes, instead of unpickling all stored
+fields of the document. The file is mapped read-only, so all processes
+serving the same index share its pages in the operating system's cache.
+
+Layout of the file, with all integers in little endian:
+
+    8 bytes     magic number
+    8 bytes     length of the JSON header
+    header      {"version", "count", "live", "fields": {name: [offsets, data]}}
+    arrays      one uint8 live flag per document, and per field count + 1
+                uint64 offsets and the UTF-8 data, each at the position given
+                in the header
+"""
+
+import json
+import mmap
+import numpy as np
+import os
+
+FILENAME = "docstore.bin"
+MAGIC = b"VLEDOCS1"
+
+def save_store(index, version, count, docs, fields):
+    """Writes a store of the given documents next to an index.
+
+    The file is replaced atomically, so readers never see a partial store.
+
+    Args:
+        index: Path to the index directory.
+        version: Version of the index the documents are from.
+        count: Number of document numbers, including deleted ones.
+        docs: Iterable of (docnum, fields dictionary) tuples of the live
+            documents.
+        fields: Names of the fields to store.
+    """
+    live = np.zeros(count, dtype=np.uint8)
+    values = {field: [b""] * count for field in fields}
+    for docnum, doc in docs:
+        live[docnum] = 1
+        for field in fields:
+            values[field][docnum] = doc.get(field, "").encode("utf-8")
+
+    def align(position):
+        return -(-position // 8) * 8
+
+    # The header holds the positions of the arrays, which depend on its own
+    # length, so the positions are computed relative to its end first
+    arrays = [live.tobytes()]
+    positions = {"live": 0}
+    position = align(len(arrays[0]))
+    positions["fields"] = {}
+    for field in fields:
+        lengths = np.fromiter((len(v) for v in values[field]), dtype=np.uint64,
+                count=count)
+        offsets = np.zeros(count + 1, dtype="<u8")
+        np.cumsum(lengths, out=offsets[1:])
+        data = b"".join(values[field])
+        positions["fields"][field] = [position, align(position +
+            offsets.nbytes)]
+        arrays.extend((offsets.tobytes(), data))
+        position = align(positions["fields"][field][1] + len(data))
+
+    def header(base):
+        return json.dumps({
+            "version": version,
+            "count": count,
+            "live": base + positions["live"],
+            "fields": {field: [base + offsets, base + data] for field,
+                (offsets, data) in positions["fields"].items()},
+        }).encode("utf-8")
+
+    # Adding the base can make the header longer, so repeat until it fits
+    base = align(16 + len(header(0)))
+    while align(16 + len(header(base))) != base:
+        base = align(16 + len(header(base)))
+    head = header(base)
+
+    filename = os.path.join(index, FILENAME)
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + len(head).to_bytes(8, "little") + head)
+        for array in arrays:
+            f.write(b"\0" * (align(f.tell()) - f.tell()))
+            f.write(array)
+    os.replace(tmp, filename)
+
+class DocumentStore():
+    def __init__(self, filename):
+        """Maps a store file into memory.
+
+        Raises:
+            ValueError: If the file isn't a document store.
+        """
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:8] != MAGIC:
+            raise ValueError("Not a document store: %s" % filename)
+        length = int.from_bytes(self.mm[8:16], "little")
+        header = json.loads(self.mm[16:16 + length].decode("utf-8"))
+
+        self.version = header["version"]
+        self.count = header["count"]
+        self.view = memoryview(self.mm)
+        self.live = np.frombuffer(self.mm, dtype=np.uint8, count=self.count,
+                offset=header["live"])
+        self.fields = {}
+        for field, (offsets, data) in header["fields"].items():
+            self.fields[field] = (np.frombuffer(self.mm, dtype="<u8",
+                count=self.count + 1, offset=offsets), data)
+
+    def __len__(self):
+        return int(self.live.sum())
+
+    def value(self, docnum, field):
+        """Returns one field of a document."""
+        offsets, data = self.fields[field]
+        start, end = offsets[docnum:docnum + 2].tolist()
+        return str(self.view[data + start:data + end], "utf-8")
+
+    def document(self, docnum):
+        """Returns all fields of a document as a dictionary."""
+        return {field: self.value(docnum, field) for field in self.fields}
+
+    def columns(self, *fields):
+        """Yields a tuple of the given fields for each live document."""
+        for docnum in np.flatnonzero(self.live).tolist():
+            yield tuple(self.value(docnum, field) for field in fields)
+
+def load_store(index, version):
+    """Returns the store saved next to an index, if it's of the given
+    version, otherwise None."""
+    try:
+        store = DocumentStore(os.path.join(index, FILENAME))
+    except (OSError, ValueError, KeyError):
+        return None
+    return store if store.version == version else None
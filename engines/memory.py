@@ -0,0 +1,282 @@
+"""
+Defines an in-memory search engine that ranks documents with BM25.
+
+The corpus is read from its CSV file into NumPy arrays, without an index on
+disk. Each field keeps its postings in compressed sparse row form: the
+documents containing term t are doc_ids[indptr[t]:indptr[t + 1]], with the
+term frequencies at the same positions in tfs. A query is scored with a few
+vectorized operations per term, and the best hits are selected with
+argpartition instead of sorting all matches.
+"""
+
+from collections import Counter, OrderedDict, defaultdict
+from whoosh.analysis import StemmingAnalyzer
+from .cache import QueryCache
+from .categories import build_tree, children
+from .corpus import read_csv
+from .results import Hit, Page
+from .suggestions import PrefixIndex, phrase_weights
+from .timing import ENGINE_SECONDS
+import numpy as np
+import os
+import threading
+import time
+
+FIELDS = ("name", "category", "description")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+class Postings():
+    """The postings of one field, in compressed sparse row form."""
+
+    def __init__(self, documents, vocabulary_size):
+        """Initializes the postings.
+
+        Args:
+            documents: List with the list of term ids of each document.
+            vocabulary_size: Number of distinct term ids.
+        """
+        term_ids, doc_ids, tfs = [], [], []
+        for doc_id, terms in enumerate(documents):
+            for term, tf in Counter(terms).items():
+                term_ids.append(term)
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        # A stable sort keeps the documents of each term in order
+        order = np.argsort(term_ids, kind="stable")
+        self.doc_ids = np.array(doc_ids, dtype=np.int32)[order]
+        self.tfs = np.array(tfs, dtype=np.float32)[order]
+        self.indptr = np.zeros(vocabulary_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=vocabulary_size),
+                out=self.indptr[1:])
+
+        self.count = len(documents)
+        lengths = np.array([len(terms) for terms in documents],
+                dtype=np.float32)
+        average = max(float(lengths.mean()), 1.0) if self.count else 1.0
+        # The document length part of the BM25 denominator
+        self.norms = K1 * (1 - B + B * lengths / average)
+
+    def score(self, term, scores):
+        """Adds the BM25 scores of a term to an array of document scores.
+
+        Returns:
+            The ids of the documents containing the term.
+        """
+        start, end = self.indptr[term], self.indptr[term + 1]
+        doc_ids = self.doc_ids[start:end]
+        if not len(doc_ids):
+            return doc_ids
+        tfs = self.tfs[start:end]
+        idf = np.log(1 + (self.count - len(doc_ids) + 0.5) /
+                (len(doc_ids) + 0.5))
+        # Each document occurs once per term, so += adds to every one
+        scores[doc_ids] += idf * tfs * (K1 + 1) / (tfs + self.norms[doc_ids])
+        return doc_ids
+
+class Corpus():
+    """An immutable snapshot of the documents and their postings."""
+
+    def __init__(self, docs, version):
+        """Analyzes the documents.
+
+        Args:
+            docs: List of document dictionaries from read_csv().
+            version: Token identifying this snapshot in the query cache.
+        """
+        self.version = version
+        self.docs = [OrderedDict((field, doc[field]) for field in ("name",
+            "link", "category", "description")) for doc in docs]
+        self.fingerprints = defaultdict(list)
+        self.links = {}
+        for doc_id, doc in enumerate(docs):
+            self.fingerprints[doc["link"]].append(doc["fingerprint"])
+            self.links.setdefault(doc["link"], doc_id)
+
+        self.analyzer = StemmingAnalyzer()
+        self.vocabulary = {}
+        documents = OrderedDict((field, []) for field in FIELDS)
+        for doc in docs:
+            for field in FIELDS:
+                documents[field].append([self.vocabulary.setdefault(term,
+                    len(self.vocabulary)) for term in self.analyze(
+                        doc[field])])
+        self.postings = [Postings(documents[field], len(self.vocabulary))
+                for field in FIELDS]
+
+        self.categories = build_tree((doc["category"], doc["name"],
+            doc["link"]) for doc in docs)
+        self.suggestions = PrefixIndex(phrase_weights((doc["name"],
+            doc["category"]) for doc in docs))
+
+    def analyze(self, text):
+        """Returns the lowercased, stemmed words of a text, without stop
+        words."""
+        return [token.text for token in self.analyzer(text)]
+
+    def rank(self, query, limit):
+        """Finds the documents containing all the query terms in any field.
+
+        Returns:
+            A tuple of the ids and scores of the best documents, best first,
+            and the total number of matching documents.
+        """
+        none = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), 0)
+
+        with ENGINE_SECONDS.time("memory", "parse"):
+            terms = set(self.analyze(query))
+            term_ids = [self.vocabulary.get(term) for term in terms]
+        if not term_ids or None in term_ids:
+            return none
+
+        with ENGINE_SECONDS.time("memory", "search"):
+            scores = np.zeros(len(self.docs), dtype=np.float32)
+            matched = np.zeros(len(self.docs), dtype=np.int32)
+            for term in term_ids:
+                found = np.zeros(len(self.docs), dtype=bool)
+                for postings in self.postings:
+                    found[postings.score(term, scores)] = True
+                matched += found
+
+            candidates = np.flatnonzero(matched == len(term_ids))
+            candidate_scores = scores[candidates]
+            if limit < len(candidates):
+                top = np.argpartition(-candidate_scores, limit - 1)[:limit]
+            else:
+                top = np.arange(len(candidates))
+            # Ties are broken by document order, like in the CSV file
+            top = top[np.lexsort((candidates[top], -candidate_scores[top]))]
+            return candidates[top], candidate_scores[top], len(candidates)
+
+    def hits(self, doc_ids, scores):
+        with ENGINE_SECONDS.time("memory", "stored_fields"):
+            return [Hit(self.docs[doc_id], float(score)) for doc_id, score
+                    in zip(doc_ids.tolist(), scores.tolist())]
+
+def file_version(filename):
+    """Returns a token that changes whenever the file is modified."""
+    st = os.stat(filename)
+    return "%d-%d" % (st.st_mtime_ns, st.st_size)
+
+class MemorySearchEngine():
+    def __init__(self, path, index=None, cache_size=1024, cache_ttl=300,
+            searchers=None, build_missing=True):
+        """Loads the corpus into memory.
+
+        Args:
+            path: Path to the corpus, without the .csv extension.
+            index: Unused, since nothing is stored on disk.
+            cache_size: Maximum number of cached query results.
+            cache_ttl: Number of seconds query results are cached.
+            searchers: Unused, since searching needs no open files.
+            build_missing: Unused, since there's no index to build.
+        """
+        self.path = path
+        self.index = index
+        self.cache = QueryCache(cache_size, cache_ttl)
+        self.lock = threading.Lock()
+
+        started = time.time()
+        self.corpus = self._load()
+        print("Loaded %d documents from %s in %.2fs" % (len(self.corpus.docs),
+            os.path.relpath(self.path + ".csv"), time.time() - started))
+
+    def _load(self):
+        filename = self.path + ".csv"
+        version = file_version(filename)
+        return Corpus(list(read_csv(filename)), version)
+
+    def update_index(self):
+        """Reloads the corpus if the CSV file has changed.
+
+        Searches in progress finish on the old snapshot of the corpus.
+
+        Returns:
+            A dictionary with the number of rows added, updated, deleted and
+            unchanged, and the time it took in seconds.
+        """
+        started = time.time()
+        with self.lock:
+            old = self.corpus.fingerprints
+            corpus = self._load()
+
+            stats = OrderedDict((("added", 0), ("updated", 0), ("deleted", 0),
+                ("unchanged", 0)))
+            for link, fingerprints in corpus.fingerprints.items():
+                if link not in old:
+                    stats["added"] += len(fingerprints)
+                elif sorted(old[link]) == sorted(fingerprints):
+                    stats["unchanged"] += len(fingerprints)
+                else:
+                    stats["updated"] += len(fingerprints)
+            stats["deleted"] = sum(len(f) for link, f in old.items()
+                    if link not in corpus.fingerprints)
+
+            if stats["added"] or stats["updated"] or stats["deleted"]:
+                self.corpus = corpus
+
+        stats["seconds"] = time.time() - started
+        return stats
+
+    def category_tree(self):
+        """Returns the nested category tree, see categories.build_tree()."""
+        with ENGINE_SECONDS.time("memory", "category_tree"):
+            return self.corpus.categories
+
+    def category_children(self, path):
+        """Returns one level of the category tree, see categories.children()."""
+        return children(self.category_tree(), path)
+
+    def select(self, query):
+        """Returns the fields of the first document with the given link."""
+        if query is None:
+            return None
+        corpus = self.corpus
+        doc_id = corpus.links.get(query.strip())
+        if doc_id is None:
+            return None
+        return dict(corpus.docs[doc_id])
+
+    def search(self, query, field="name", limit=200):
+        query = " ".join(query.split())
+        corpus = self.corpus
+        yield self.cache.get(("search", query, limit), corpus.version,
+                lambda: corpus.hits(*corpus.rank(query, limit)[:2]))
+
+    def search_page(self, query, page=1, pagesize=20):
+        """Returns one page of hits for the given query.
+
+        Page numbers past the last page return the last page.
+        """
+        query = " ".join(query.split())
+        page = max(1, page)
+        corpus = self.corpus
+        return self.cache.get(("search_page", query, page, pagesize),
+                corpus.version, lambda: self._search_page(corpus, query, page,
+                    pagesize))
+
+    def _search_page(self, corpus, query, page, pagesize):
+        doc_ids, scores, total = corpus.rank(query, page * pagesize)
+        page = min(page, max(1, -(-total // pagesize)))
+        offset = (page - 1) * pagesize
+        return Page(corpus.hits(doc_ids[offset:offset + pagesize],
+            scores[offset:offset + pagesize]), page, pagesize, total)
+
+    def suggestions(self):
+        """Returns the prefix index of name and category phrases."""
+        return self.corpus.suggestions
+
+    def suggest(self, query, field="name", limit=20):
+        """Returns search suggestions for the given query."""
+        with ENGINE_SECONDS.time("memory", "suggest"):
+            query = " ".join(query.lower().split())
+            corpus = self.corpus
+            return self.cache.get(("suggest", query, limit), corpus.version,
+                    lambda: corpus.suggestions.lookup(query, limit=limit))
+
+    def close(self):
+        pass
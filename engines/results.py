@@ -0,0 +1,43 @@
+"""
+Search results that don't depend on an open searcher.
+"""
+
+class Hit(dict):
+    """A search result holding its stored fields and score.
+
+    Unlike Whoosh hits, it doesn't need an open searcher, so it can be kept
+    in the cache.
+    """
+
+    def __init__(self, fields, score):
+        super().__init__(fields)
+        self.score = score
+
+class Page():
+    """One page of search results, numbered from 1."""
+
+    def __init__(self, hits, pagenum, pagesize, total):
+        """Initializes the page.
+
+        Args:
+            hits: List of Hit objects on this page.
+            pagenum: Number of this page.
+            pagesize: Maximum number of hits on a page.
+            total: Total number of hits matching the query.
+        """
+        self.hits = hits
+        self.pagenum = pagenum
+        self.pagesize = pagesize
+        self.total = total
+        self.pagecount = max(1, -(-total // pagesize))
+
+    @property
+    def offset(self):
+        """Rank of the first hit on this page, starting at zero."""
+        return (self.pagenum - 1) * self.pagesize
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
@@ -0,0 +1,91 @@
+"""
+In-memory prefix index used for search suggestions.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import re
+
+def words(phrase):
+    """Returns the lowercased words of a phrase."""
+    return re.findall(r"\w+", phrase.lower())
+
+def phrase_weights(records):
+    """Counts the documents of each name and category phrase.
+
+    Args:
+        records: Iterable of (name, category) tuples, where category is a
+            comma separated path of category names.
+    """
+    weights = Counter()
+    for name, category in records:
+        weights[name.strip()] += 1
+        for cat in set(category.split(",")):
+            weights[cat.strip()] += 1
+    del weights[""]
+    return weights
+
+class PrefixIndex():
+    """Looks up phrases by the prefix of any of their words.
+
+    Every (word, phrase) pair is kept in a sorted array, so that the words
+    starting with a prefix form a contiguous range found by bisection.
+    Phrases are numbered by rank, so that the best matches in a range are the
+    ones with the lowest numbers.
+    """
+
+    # Results for prefixes up to this length are memoized, since their
+    # ranges are the largest
+    SHORT_PREFIX = 2
+
+    def __init__(self, weights):
+        """Initializes the index.
+
+        Args:
+            weights: Mapping from phrases to their document frequency.
+        """
+        self.phrases = sorted(weights, key=lambda p: (-weights[p], p))
+        self.phrase_words = [set(words(p)) for p in self.phrases]
+
+        entries = sorted((word, rank) for rank, ws in
+                enumerate(self.phrase_words) for word in ws)
+        self.words = [word for word, rank in entries]
+        self.ranks = [rank for word, rank in entries]
+        self._short = {}
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def _matches(self, prefix):
+        """Returns the ranks of the phrases with a word starting with prefix."""
+        lo = bisect_left(self.words, prefix)
+        hi = bisect_left(self.words, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return set(self.ranks[lo:hi])
+
+    def lookup(self, query, limit=20):
+        """Returns the best phrases for the given query.
+
+        The last word of the query is treated as a prefix, while the phrases
+        must contain all the other words.
+        """
+        query_words = words(query)
+        if not query_words:
+            return []
+
+        prefix = query_words.pop()
+        context = set(query_words)
+
+        if context:
+            ranks = (r for r in self._matches(prefix)
+                    if context <= self.phrase_words[r])
+        elif len(prefix) <= self.SHORT_PREFIX:
+            key = (prefix, limit)
+            if key not in self._short:
+                self._short[key] = heapq.nsmallest(limit,
+                        self._matches(prefix))
+            ranks = self._short[key]
+        else:
+            ranks = self._matches(prefix)
+
+        return [self.phrases[r] for r in heapq.nsmallest(limit, ranks)]
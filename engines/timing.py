@@ -0,0 +1,8 @@
+"""
+Times the stages of the search engines.
+"""
+
+import metrics
+
+ENGINE_SECONDS = metrics.histogram("vle_engine_seconds",
+        "Time spent in each stage of the search engine.", ("engine", "stage"))
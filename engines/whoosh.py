@@ -2,157 +2,583 @@
 Defines the Whoosh search engine.
 """
 
-from collections import deque
+from collections import OrderedDict, defaultdict
 from whoosh.analysis import StemmingAnalyzer, NgramWordAnalyzer, KeywordAnalyzer
-from whoosh.fields import Schema, TEXT, KEYWORD
-from whoosh.qparser import QueryParser, MultifieldParser, SequencePlugin
+from whoosh.fields import Schema, TEXT, KEYWORD, ID, STORED
+from whoosh.qparser import MultifieldParser, SequencePlugin
+from whoosh.system import pack_uint
+from .cache import QueryCache
+from .categories import build_tree, children, load_tree, save_tree
+from .corpus import is_directory, read_csv, read_directory
+from .docstore import load_store, save_store
+from .results import Hit, Page
+from .suggestions import PrefixIndex, phrase_weights
+from .timing import ENGINE_SECONDS
 import contextlib
+import hashlib
 import os
+import queue
+import threading
+import time
 import whoosh
 
+# Fields that are read when serving, kept in the document store
+STORED_FIELDS = ("name", "link", "category", "description")
+
+# Fields that queries are matched against
+SEARCH_FIELDS = ("name", "category", "description", "body")
+
+class TermCounts(TEXT):
+    """A text field that can also be indexed from counts of analyzed words.
+
+    The text files of directory corpora are analyzed while they're read, so
+    their whole text is never held in memory. Word positions aren't kept, so
+    phrase queries aren't supported.
+    """
+
+    def __init__(self, analyzer):
+        super().__init__(analyzer=analyzer, phrase=False)
+
+    def index(self, value, **kwargs):
+        if not isinstance(value, dict):
+            return super().index(value, **kwargs)
+        boost = self.format.field_boost
+        return ((word.encode("utf-8"), freq, freq * boost, pack_uint(freq))
+                for word, freq in sorted(value.items()))
+
+def make_schema():
+    """Returns the schema used for ontology and directory indexes."""
+    analyzer = NgramWordAnalyzer(2, 4)
+    return Schema(
+        name = TEXT(stored=True, analyzer=StemmingAnalyzer()),
+        link = ID(stored=True, unique=True),
+        category = KEYWORD(stored=True, scorable=True, commas=True, analyzer=analyzer),
+        description = TEXT(stored=True),
+        body = TermCounts(StemmingAnalyzer()),
+        fingerprint = STORED(),
+    )
+
+def read_corpus(path, schema, procs=1):
+    """Returns an iterator of the document dictionaries of a corpus.
+
+    Args:
+        path: Path to the corpus, a directory of text files or an ontology CSV
+            file without the .csv extension.
+        schema: Schema of the index, whose body analyzer is used for text
+            files.
+        procs: Number of processes reading text files.
+    """
+    if is_directory(path):
+        return read_directory(path, schema["body"].analyzer, procs=procs)
+    return read_csv(path + ".csv")
+
+def toc_version(generation, segments):
+    """Returns a token identifying a generation of an index by its segments."""
+    ids = ",".join(segment.segment_id() for segment in segments)
+    digest = hashlib.sha1(ids.encode("utf-8")).hexdigest()
+    return "%d-%s" % (generation, digest[:16])
+
+# The last version read from the TOC of each index, by its directory and name
+_toc_versions = {}
+
+# Number of times the index files are looked for before they're missing, with
+# a delay doubling from a millisecond in between
+RETRIES = 8
+
+def _retrying(function):
+    """Calls a function reading the index files, retrying while they're
+    missing, e.g. while a commit replaces the TOC or rebuild_index() swaps
+    the index directory for a symlink."""
+    delay = 0.001
+    for _ in range(RETRIES - 1):
+        try:
+            return function()
+        except (FileNotFoundError, whoosh.index.EmptyIndexError):
+            time.sleep(delay)
+            delay *= 2
+    return function()
+
+def index_version(ix):
+    """Returns a token that changes with every commit to the index.
+
+    The generation number alone is not enough, since rebuilding an index
+    starts counting from scratch, so the ids of its segments are added.
+    Unlike file times, they survive copying the index, e.g. in a snapshot.
+
+    Reading the TOC is slow compared to a cached query, so it's only read
+    again when the latest generation or its TOC file has changed. While the
+    index is missing, the last version read is returned, so searchers that
+    are open keep being used.
+    """
+    key = (ix.storage.folder, ix.indexname)
+    cached, version = _toc_versions.get(key, (None, None))
+    if version is not None:
+        try:
+            return _read_version(ix, key)
+        except (FileNotFoundError, whoosh.index.EmptyIndexError):
+            return version
+    return _retrying(lambda: _read_version(ix, key))
+
+def _read_version(ix, key):
+    generation = ix.latest_generation()
+    if generation < 0:
+        raise whoosh.index.EmptyIndexError("Index %r does not exist in %r" % (
+            ix.indexname, ix.storage.folder))
+    stat = os.stat(os.path.join(ix.storage.folder,
+        whoosh.index.TOC._filename(ix.indexname, generation)))
+    changed = (generation, stat.st_dev, stat.st_ino, stat.st_size,
+            stat.st_mtime_ns)
+    cached, version = _toc_versions.get(key, (None, None))
+    if cached == changed:
+        return version
+    toc = ix._read_toc()
+    version = toc_version(toc.generation, toc.segments)
+    if toc.generation == generation:
+        _toc_versions[key] = (changed, version)
+    return version
+
+def opened_version(reader):
+    """Returns the version of the index a reader or searcher has open, or
+    None for an empty index, see index_version()."""
+    if hasattr(reader, "reader"):
+        reader = reader.reader()
+    if reader.generation() is None:
+        return None
+    return toc_version(reader.generation(), [r.segment() for r, _ in
+        reader.leaf_readers()])
+
+def save_document_store(ix):
+    """Copies the stored fields of the index to a document store next to it.
+
+    Returns:
+        The new DocumentStore.
+    """
+    with ix.reader() as r:
+        # The latest version may already be newer than the reader's, while
+        # an empty index has no document numbers to get wrong
+        version = opened_version(r) or index_version(ix)
+        save_store(ix.storage.folder, version, r.doc_count_all(),
+                r.iter_docs(), STORED_FIELDS)
+    return load_store(ix.storage.folder, version)
+
+def save_category_tree(ix, store):
+    """Computes the category tree of a document store and saves it next to
+    the index."""
+    tree = build_tree(store.columns("category", "name", "link"))
+    save_tree(ix.storage.folder, store.version, tree)
+    return store.version, tree
+
+class SearcherPool():
+    """A small pool of long-lived searchers shared by threads.
+
+    Whoosh searchers can't be used by several threads at once, so each thread
+    borrows one for the duration of a query. A searcher is only refreshed
+    when the index version has changed since it was opened, and is labeled
+    with the version it actually opened, which may be newer than the one
+    asked for if a commit lands in between. Once drained for
+    a new version, searchers of older versions are closed as soon as they're
+    idle, so the files of replaced indexes aren't kept open.
+    """
+
+    def __init__(self, ix, size=4):
+        """Initializes the pool.
+
+        Args:
+            ix: The index to search.
+            size: Maximum number of searchers.
+        """
+        self.ix = ix
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def searcher(self, version):
+        """Borrows a searcher for the given index version or a newer one."""
+        with self.lock:
+            create = self.idle.empty() and self.created < self.size
+            if create:
+                self.created += 1
+
+        if create:
+            try:
+                searcher = _retrying(self.ix.searcher)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+            searcher_version = opened_version(searcher)
+        else:
+            searcher_version, searcher = self.idle.get()
+
+        try:
+            if searcher_version != version:
+                # A fresh searcher closes the readers it doesn't reuse
+                fresh = _retrying(searcher.refresh)
+                if fresh is searcher:
+                    # Rebuilt indexes restart at the same generation number
+                    searcher.close()
+                    fresh = _retrying(self.ix.searcher)
+                searcher_version, searcher = opened_version(fresh), fresh
+            yield searcher
+        finally:
+            with self.lock:
+                stale = self.version is not None and \
+                        searcher_version != self.version
+                if stale:
+                    self.created -= 1
+            if stale:
+                searcher.close()
+            else:
+                self.idle.put((searcher_version, searcher))
+
+    def drain(self, version):
+        """Closes the idle searchers of other versions than the given one,
+        and the busy ones once they're returned."""
+        with self.lock:
+            self.version = version
+        keep = []
+        while True:
+            try:
+                searcher_version, searcher = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if searcher_version == version:
+                keep.append((searcher_version, searcher))
+            else:
+                searcher.close()
+                with self.lock:
+                    self.created -= 1
+        for item in reversed(keep):
+            self.idle.put(item)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get()[1].close()
+
 class WhooshSearchEngine():
-    def __init__(self, path, index):
+    def __init__(self, path, index, cache_size=1024, cache_ttl=300,
+            searchers=4, build_missing=True):
         """Initializes the search engine.
 
         Args:
             path: Path to document root to index
             index: Path to where the index will be placed.
+            cache_size: Maximum number of cached query results.
+            cache_ttl: Number of seconds query results are cached.
+            searchers: Maximum number of searchers used concurrently.
+            build_missing: Whether to build the index if it's missing or
+                outdated, instead of raising FileNotFoundError.
         """
         self.path = path
         self.index = index
-        analyzer = NgramWordAnalyzer(2, 4)
 
+        print("Opening index %s" % self.index)
         try:
-            ix = whoosh.index.open_dir(self.index)
-            ix.close()
-            create_index = False # index seems to be working fine
+            self.ix = whoosh.index.open_dir(self.index)
         except whoosh.index.EmptyIndexError:
-            create_index = True
+            self.ix = None
 
-        if create_index:
-            schema = Schema(
-                name = TEXT(stored=True, analyzer=StemmingAnalyzer()),
-                link = TEXT(stored=True),
-                category = KEYWORD(stored=True, scorable=True, commas=True, analyzer=analyzer),
-                description = TEXT(stored=True),
-            )
+        # Indexes created before rows were fingerprinted can't be updated
+        # incrementally, and those without a body field can't search text
+        # files, so they are rebuilt.
+        if self.ix is not None and ("fingerprint" not in self.ix.schema or
+                "body" not in self.ix.schema):
+            print("Index %s is outdated" % os.path.relpath(self.index))
+            self.ix.close()
+            self.ix = None
 
-            if not os.path.isdir(self.index):
-                os.mkdir(self.index)
+        if self.ix is None:
+            if not build_missing:
+                raise FileNotFoundError("No up to date index in %s" %
+                        self.index)
+            self.build(self.path, self.index)
+            self.ix = whoosh.index.open_dir(self.index)
 
-            print("Creating index %s" % os.path.relpath(self.index))
-            with contextlib.closing(whoosh.index.create_in(self.index,
-                schema)) as ix:
-                self._index(ix, self.path)
+        # Reading ix.schema reads the TOC, and rebuilt versions have the same
+        # schema
+        self.schema = self.ix.schema
+        self._categories = (None, None)
+        self._suggestions = (None, None)
+        self._store = (None, None)
+        # Keeps concurrent requests from rebuilding the same structures
+        self._build_lock = threading.RLock()
+        self.cache = QueryCache(cache_size, cache_ttl)
+        self.searchers = SearcherPool(self.ix, searchers)
 
-        print("Opening index %s" % self.index)
-        self.ix = whoosh.index.open_dir(self.index)
-
-    def _index(self, ix, root):
-        def index_directory(writer, path, depth_first=False):
-            """A recursive indexer."""
-            # TODO: Use the "csv" module for reading these files
-            subdirs = deque()
-            filename = self.path + ".csv"
-            with open(filename) as file:
-                for line_number, line in enumerate(file, 1):
-                    if line.startswith("#"):
-                        # Skip comments or header fields
-                        continue
-
-                    line = line.rstrip() # removes trailiing CRLF
-                    fields = line.split(",")
-
-                    try:
-                        name = fields[2]
-                        category = ",".join(fields[0].split(";"))
-                        link = fields[1]
-                    except IndexError as error:
-                        print("%s:%d: %s: %r" % (os.path.basename(filename),
-                            line_number, error, line))
-                        raise RuntimeError("The CSV file seems to be invalid."
-                                + " Check for proper use of separators.") from error
-
-                    try:
-                        # In the CSV file, it seems that the description is
-                        # optional
-                        description = fields[3]
-                    except IndexError:
-                        print("%s:%d: warning: missing description: %r" %
-                                (os.path.basename(filename), line_number,
-                                    line))
-                        description = ""
-
-                    writer.add_document(
-                        name=name,
-                        link=link,
-                        category=category,
-                        description=description)
-        writer = ix.writer()
-        index_directory(writer, root)
-        writer.commit()
+    @classmethod
+    def build(cls, path, index, procs=1, limitmb=128, batchsize=100):
+        """Creates a new index from scratch, replacing any existing one.
 
+        The CSV file is streamed row by row. With several processes, rows are
+        handed to the sub-writers in batches, where they are analyzed and
+        written as segments that are merged on commit.
+
+        The text files of a directory corpus are read in chunks and analyzed
+        by the given number of processes instead, and written by one writer.
+
+        Args:
+            path: Path to document root to index
+            index: Path to where the index will be placed.
+            procs: Number of processes analyzing documents.
+            limitmb: Memory limit in megabytes for each process' pool.
+            batchsize: Number of rows sent to a sub-writer at a time.
+
+        Returns:
+            A dictionary with the number of rows or files indexed and the time
+            it took in seconds.
+        """
+        started = time.time()
+        if not os.path.isdir(index):
+            os.mkdir(index)
+
+        print("Creating index %s" % os.path.relpath(index))
+        with contextlib.closing(whoosh.index.create_in(index,
+            make_schema())) as ix:
+            if procs > 1 and not is_directory(path):
+                writer = ix.writer(procs=procs, limitmb=limitmb,
+                        batchsize=batchsize)
+            else:
+                writer = ix.writer(limitmb=limitmb)
+
+            rows = 0
+            for doc in read_corpus(path, ix.schema, procs=procs):
+                writer.add_document(**doc)
+                rows += 1
+            writer.commit()
+            save_category_tree(ix, save_document_store(ix))
+
+        return {"rows": rows, "seconds": time.time() - started}
+
+    def update_index(self):
+        """Brings the index up to date with the CSV file or text files.
+
+        Rows are grouped by link and compared by fingerprint, so only the
+        documents of added, changed or removed links are rewritten. Text
+        files are fingerprinted by a digest of their contents.
+
+        Returns:
+            A dictionary with the number of rows added, updated, deleted and
+            unchanged, and the time it took in seconds.
+        """
+        started = time.time()
+        stats = OrderedDict((("added", 0), ("updated", 0), ("deleted", 0),
+            ("unchanged", 0)))
+
+        indexed = defaultdict(list)
+        with self.ix.reader() as r:
+            for fields in r.all_stored_fields():
+                indexed[fields["link"]].append(fields["fingerprint"])
+
+        rows = OrderedDict()
+        for doc in read_corpus(self.path, self.ix.schema):
+            rows.setdefault(doc["link"], []).append(doc)
+
+        writer = self.ix.writer()
+        for link, docs in rows.items():
+            old = indexed.pop(link, None)
+            if old is not None and sorted(old) == sorted(d["fingerprint"]
+                    for d in docs):
+                stats["unchanged"] += len(docs)
+                continue
+
+            stats["added" if old is None else "updated"] += len(docs)
+            # update_document() only replaces the first document with a
+            # given link, so links shared by several rows are cleared first.
+            if old is not None and len(old) > 1:
+                writer.delete_by_term("link", link)
+            writer.update_document(**docs[0])
+            for doc in docs[1:]:
+                writer.add_document(**doc)
+
+        for link, old in indexed.items():
+            writer.delete_by_term("link", link)
+            stats["deleted"] += len(old)
+
+        if stats["added"] or stats["updated"] or stats["deleted"]:
+            writer.commit()
+            store = save_document_store(self.ix)
+            self._store = (store.version, store)
+            self._categories = save_category_tree(self.ix, store)
+        else:
+            writer.cancel()
+
+        stats["seconds"] = time.time() - started
+        return stats
 
     def category_tree(self):
-        from collections import OrderedDict
-        from natsort import natsorted
-        out = dict()
+        """Returns the nested category tree of the current index version.
 
-        def sortOD(od):
-            res = OrderedDict()
-            for k, v in natsorted(od.items()):
-                if isinstance(v, dict):
-                    res[k] = sortOD(v)
-                else:
-                    res[k] = v
-            return res
+        The tree is kept in memory, and loaded from the file saved at index
+        time or recomputed whenever a new version of the index is committed.
+        """
+        with ENGINE_SECONDS.time("whoosh", "category_tree"):
+            version = index_version(self.ix)
+            cached_version, tree = self._categories
+            if cached_version != version:
+                with self._build_lock:
+                    cached_version, tree = self._categories
+                    if cached_version != version:
+                        tree = load_tree(self.index, version)
+                        if tree is None:
+                            version, tree = save_category_tree(self.ix,
+                                    self.document_store())
+                        self._categories = (version, tree)
+            return tree
 
-        with self.ix.reader() as s:
-            for r in s.all_stored_fields():
-                categories = r["category"].split(",")
+    def document_store(self):
+        """Returns the document store of the current index version.
 
-                current = out
-                for cat in categories:
-                    if cat not in current:
-                        current[cat] = {}
-                    current = current[cat]
+        It's written at index time, and written here if it's missing or out
+        of date, e.g. for indexes built by older versions.
+        """
+        version = index_version(self.ix)
+        cached_version, store = self._store
+        if cached_version != version:
+            with self._build_lock:
+                cached_version, store = self._store
+                if cached_version != version:
+                    store = load_store(self.index, version)
+                    if store is None:
+                        store = save_document_store(self.ix)
+                    self._store = (store.version, store)
+                    self.searchers.drain(store.version)
+        return store
 
-                current[r["name"]] = r["link"]
+    def _fields(self, searcher):
+        """Returns a function that reads the fields of a document number of a
+        searcher, from the document store if it's of the same version as the
+        searcher, otherwise None."""
+        store = self.document_store()
+        if store.version == opened_version(searcher):
+            return store.document
+        return None
 
-        return sortOD(out)
+    def category_children(self, path):
+        """Returns one level of the category tree, see categories.children()."""
+        return children(self.category_tree(), path)
 
     def select(self, query):
-        qp = QueryParser("link", schema=self.ix.schema)
+        """Returns the stored fields of the document with the given link.
+
+        The link is looked up directly in the term dictionary of the link
+        field, without parsing or scoring a query.
+        """
+        if query is None:
+            return None
+        link = query.strip()
+        version = index_version(self.ix)
+        return self.cache.get(("select", link), version,
+                lambda: self._select(link, version))
 
-        results = []
-        with self.ix.searcher() as s:
-            for r in s.search(qp.parse(query), limit=10):
-                return dict(r)
+    def _select(self, link, version):
+        with self.searchers.searcher(version) as s:
+            fields = self._fields(s)
+            with ENGINE_SECONDS.time("whoosh", "search"):
+                docnum = s.document_number(link=link)
+            if docnum is None:
+                return None
+            with ENGINE_SECONDS.time("whoosh", "stored_fields"):
+                return (fields or s.stored_fields)(docnum)
 
     def search(self, query, field="name", limit=200):
-        qp = MultifieldParser(["name", "category", "description"], schema=self.ix.schema)
+        fields = SEARCH_FIELDS
+        query = " ".join(query.split())
+        version = index_version(self.ix)
+        yield self.cache.get(("search", query, fields, limit), version,
+                lambda: self._search(query, fields, limit, version))
+
+    def _search(self, query, fields, limit, version):
+        with ENGINE_SECONDS.time("whoosh", "parse"):
+            parsed = MultifieldParser(fields, schema=self.schema).parse(
+                    query)
+
+        with self.searchers.searcher(version) as s:
+            fields = self._fields(s)
+            with ENGINE_SECONDS.time("whoosh", "search"):
+                results = s.search(parsed, limit=limit)
+            with ENGINE_SECONDS.time("whoosh", "stored_fields"):
+                return [Hit(fields(r.docnum) if fields else r.fields(),
+                    r.score) for r in results]
 
-        with self.ix.searcher() as s:
-            yield s.search(qp.parse(query), limit=limit)
+    def search_page(self, query, page=1, pagesize=20):
+        """Returns one page of hits for the given query.
+
+        Hits are ranked by score, and stored fields are only loaded for the
+        hits on the requested page. Page numbers past the last page return
+        the last page.
+        """
+        fields = SEARCH_FIELDS
+        query = " ".join(query.split())
+        page = max(1, page)
+        version = index_version(self.ix)
+        return self.cache.get(("search_page", query, fields, page, pagesize),
+                version, lambda: self._search_page(query, fields, page,
+                    pagesize, version))
+
+    def _search_page(self, query, fields, page, pagesize, version):
+        with ENGINE_SECONDS.time("whoosh", "parse"):
+            parsed = MultifieldParser(fields, schema=self.schema).parse(
+                    query)
+
+        with self.searchers.searcher(version) as s:
+            fields = self._fields(s)
+            with ENGINE_SECONDS.time("whoosh", "search"):
+                results = s.search(parsed, limit=page * pagesize)
+                total = len(results)
+            page = min(page, max(1, -(-total // pagesize)))
+            offset = (page - 1) * pagesize
+            with ENGINE_SECONDS.time("whoosh", "stored_fields"):
+                hits = [Hit(fields(r.docnum) if fields else r.fields(),
+                    r.score) for r in results[offset:offset + pagesize]]
+            return Page(hits, page, pagesize, total)
+
+    def suggestions(self):
+        """Returns the prefix index of name and category phrases.
+
+        It is built from the document store the first time it's needed and
+        whenever a new version of the index is committed.
+        """
+        version = index_version(self.ix)
+        cached_version, suggestions = self._suggestions
+        if cached_version != version:
+            with self._build_lock:
+                cached_version, suggestions = self._suggestions
+                if cached_version != version:
+                    store = self.document_store()
+                    suggestions = PrefixIndex(phrase_weights(
+                        store.columns("name", "category")))
+                    self._suggestions = (store.version, suggestions)
+        return suggestions
 
     def suggest(self, query, field="name", limit=20):
         """Returns search suggestions for the given query."""
-        out = []
-        query = query.lower()
-        curr = query.split(" ").pop()
+        with ENGINE_SECONDS.time("whoosh", "suggest"):
+            query = " ".join(query.lower().split())
+            return self.cache.get(("suggest", query, limit),
+                    index_version(self.ix),
+                    lambda: self.suggestions().lookup(query, limit=limit))
 
-        with self.ix.reader() as s:
-            for i, hit in enumerate(s.expand_prefix("name", curr)):
-                break
-                out.append(str(hit, encoding="utf-8"))
-
-            for i, hit in enumerate(s.expand_prefix("category", curr)):
-                break
-                out.append(str(hit, encoding="utf-8"))
+    def warm_up(self):
+        """Builds what is otherwise built by the first requests.
 
-        qp = MultifieldParser(["name", "category", "description"], schema=self.ix.schema)
-        with self.ix.searcher() as s:
-            for r in s.search(qp.parse(query), limit=limit):
-                out.append(r["name"])
+        Loads the category tree and the suggestions, and opens all pooled
+        searchers and runs a query with them. Meant to be called in each
+        worker process after it's forked.
+        """
+        self.document_store()
+        self.category_tree()
+        self.suggestions()
+        fields = SEARCH_FIELDS
+        version = index_version(self.ix)
+        with contextlib.ExitStack() as stack:
+            for _ in range(self.searchers.size):
+                s = stack.enter_context(self.searchers.searcher(version))
+                s.search(MultifieldParser(fields, schema=self.schema).parse(
+                    "warm"), limit=1)
 
-        return out
+    def close(self):
+        self.searchers.close()
+        self.ix.close()
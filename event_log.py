@@ -0,0 +1,131 @@
+"""
+An append-only log of the interaction statistics sent by the test pages.
+
+Events are stored as JSON Lines. Appending only queues the events; a
+background thread writes them in batches and syncs the file to disk at a
+fixed interval, so requests never wait for the disk.
+"""
+
+import atexit
+import json
+import os
+import threading
+
+FILENAME = os.path.join("user_data", "events.jsonl")
+
+class EventLog():
+    def __init__(self, filename, interval=1.0):
+        """Initializes the log.
+
+        Args:
+            filename: Path to the JSON Lines file.
+            interval: Number of seconds between writes to disk.
+        """
+        self.filename = filename
+        self.interval = interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+
+    def _start(self):
+        # The writer is started per process, since threads don't survive
+        # a fork
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self._run, name="event-log",
+                daemon=True)
+        thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def append(self, records):
+        """Queues records, which are dictionaries, for writing."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pending = []
+                self._start()
+            self.pending.extend(records)
+
+    def flush(self):
+        """Writes and syncs all queued records."""
+        with self.write_lock:
+            with self.lock:
+                records, self.pending = self.pending, []
+            if not records:
+                return
+
+            data = "".join(json.dumps(r, separators=(",", ":")) + "\n"
+                    for r in records).encode("utf-8")
+
+            # A single write to a file opened for appending can't be
+            # interleaved with writes from other processes
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o644)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def read(self):
+        """Yields all records written so far, oldest first."""
+        self.flush()
+        try:
+            f = open(self.filename, "rt", encoding="utf-8")
+        except FileNotFoundError:
+            return
+
+        with f:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+
+    def read_since(self, offset, size=1 << 20):
+        """Returns the records written after a byte offset of the log.
+
+        At most about size bytes are read, so a large log is read in bounded
+        chunks by calling this again with the returned offset, until the
+        offset stops changing.
+
+        Returns:
+            A tuple of the list of records and the offset to continue from.
+        """
+        self.flush()
+        try:
+            f = open(self.filename, "rb")
+        except FileNotFoundError:
+            return [], 0
+
+        with f:
+            f.seek(offset)
+            data = f.read(size)
+            while data and b"\n" not in data:
+                # A record longer than size is read whole
+                more = f.read(size)
+                if not more:
+                    break
+                data += more
+
+        # Leaves out a line that another process is still writing
+        end = data.rfind(b"\n") + 1
+        records = [json.loads(line) for line in
+                data[:end].decode("utf-8").splitlines()]
+        return records, offset + end
+
+_event_log = None
+_event_log_lock = threading.Lock()
+
+def get_event_log():
+    """Returns the event log shared by the process."""
+    global _event_log
+    with _event_log_lock:
+        if _event_log is None:
+            _event_log = EventLog(FILENAME)
+    return _event_log
@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+
+"""
+Aggregates the click and key press coordinates of the event log into
+heatmaps.
+
+Events are binned into grids of fixed resolution, per task id, per view and
+overall. The grids are updated with the events appended to the log since
+the last update, and the JSON for heatmap.js is cached until the log grows,
+so the cost of a request depends on the grid size, not the number of events.
+"""
+
+from collections import OrderedDict
+from event_log import get_event_log
+import argparse
+import json
+import os
+import threading
+import numpy as np
+
+class Heatmaps():
+    def __init__(self, log, cell=10, width=2000, height=4000):
+        """Initializes empty grids.
+
+        Args:
+            log: The EventLog to aggregate.
+            cell: Width and height of a grid cell in pixels.
+            width: Width of the page area covered by the grids in pixels.
+            height: Height of the page area covered by the grids in pixels.
+        """
+        self.log = log
+        self.cell = cell
+        self.shape = (-(-height // cell), -(-width // cell))
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.offset = 0
+        self.grids = {}
+        self.cache = {}
+
+    def update(self):
+        """Bins the events appended to the log since the last update.
+
+        Returns:
+            The version of the grids, which is the log offset they cover.
+        """
+        with self.lock:
+            try:
+                if os.path.getsize(self.log.filename) < self.offset:
+                    # The log has been replaced
+                    self._reset()
+            except FileNotFoundError:
+                self._reset()
+
+            # The log is read in chunks, so memory use doesn't depend on
+            # its size
+            offset = self.offset
+            while True:
+                records, end = self.log.read_since(offset)
+                if end == offset:
+                    break
+                self._bin(records)
+                offset = end
+
+            if offset != self.offset:
+                self.cache.clear()
+            self.offset = offset
+            return offset
+
+    def _bin(self, records):
+        """Adds the coordinates of a chunk of records to the grids."""
+        records = [r for r in records if isinstance(r.get("x_pos"),
+            (int, float)) and isinstance(r.get("y_pos"), (int, float))]
+        if not records:
+            return
+
+        rows = np.array([r["y_pos"] for r in records]) // self.cell
+        cols = np.array([r["x_pos"] for r in records]) // self.cell
+        inside = ((rows >= 0) & (rows < self.shape[0]) &
+                (cols >= 0) & (cols < self.shape[1]))
+        cells = (rows * self.shape[1] + cols).astype(int)
+
+        for grouping, keys in (
+                ("task", np.array([str(r.get("task_id")) for r in records])),
+                ("view", np.array([str(r.get("view")) for r in records])),
+                ("all", np.full(len(records), ""))):
+            for key in np.unique(keys):
+                selected = cells[inside & (keys == key)]
+                grid = self.grids.setdefault((grouping, key),
+                        np.zeros(self.shape[0] * self.shape[1],
+                            dtype=np.int64))
+                grid += np.bincount(selected, minlength=grid.size)
+
+    def heatmap(self, task_id=None, view=None):
+        """Returns a heatmap in the format of heatmap.js' setData().
+
+        Only cells with events are included, with x and y at their center.
+
+        Args:
+            task_id: Only include events of this task id.
+            view: Only include events of this view, unless task_id is given.
+        """
+        if task_id is not None:
+            key = ("task", str(task_id))
+        elif view is not None:
+            key = ("view", view)
+        else:
+            key = ("all", "")
+
+        version = self.update()
+        with self.lock:
+            if (version, key) not in self.cache:
+                grid = self.grids.get(key, np.zeros(0, dtype=np.int64))
+                cells = np.flatnonzero(grid)
+                rows, cols = np.divmod(cells, self.shape[1])
+                half = self.cell // 2
+                self.cache[(version, key)] = OrderedDict((
+                    ("max", int(grid.max()) if grid.size else 0),
+                    ("min", 0),
+                    ("data", [{"x": int(x), "y": int(y), "value": int(v)}
+                        for x, y, v in zip(cols * self.cell + half,
+                            rows * self.cell + half, grid[cells])]),
+                ))
+            return self.cache[(version, key)]
+
+_heatmaps = None
+_heatmaps_lock = threading.Lock()
+
+def get_heatmaps():
+    """Returns the heatmaps of the shared event log."""
+    global _heatmaps
+    with _heatmaps_lock:
+        if _heatmaps is None:
+            _heatmaps = Heatmaps(get_event_log())
+    return _heatmaps
+
+def main():
+    p = argparse.ArgumentParser(description="Prints a heatmap as JSON.")
+    p.add_argument("--task", type=int, default=None,
+        help="Only include events of this task id.")
+    p.add_argument("--view", type=str, default=None,
+        help="Only include events of this view.")
+    p.add_argument("--cell", type=int, default=10,
+        help="Cell size in pixels.")
+    opts = p.parse_args()
+
+    heatmaps = Heatmaps(get_event_log(), cell=opts.cell)
+    print(json.dumps(heatmaps.heatmap(task_id=opts.task, view=opts.view)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Latency histograms, exposed in the Prometheus text format.
+
+Histograms are registered by name in the process, so each module can define
+the ones it needs at import time, and render() includes all of them. Values
+are per process, unless set_directory() is called before forking worker
+processes: then each process saves its values to a file in that directory,
+and render() adds up the files of all processes.
+"""
+
+from collections import OrderedDict
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds, from sub-millisecond cache hits to slow rebuilds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+
+# Number of seconds between saves of a process' values, see set_directory()
+FLUSH_INTERVAL = 1.0
+
+# Prefix of the files of the processes' values
+PREFIX = "metrics_"
+
+class Histogram():
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        """Initializes an empty histogram.
+
+        Args:
+            name: Metric name, e.g. "vle_request_seconds".
+            description: One line of help text.
+            labels: Names of the labels each observation is given.
+            buckets: Sorted upper bounds of the buckets.
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # Label values -> [count per bucket, sum, count]
+        self.series = OrderedDict()
+
+    def observe(self, value, *labels):
+        """Records a value, given the label values in order."""
+        if len(labels) != len(self.labels):
+            raise ValueError("%s expects labels %s, got %r" % (self.name,
+                self.labels, labels))
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0,
+                        0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+        _changed()
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """Records the number of seconds spent in the with block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def snapshot(self):
+        """Returns the histogram's values as a JSON serializable dictionary."""
+        with self.lock:
+            series = [[list(labels), list(counts), total, count] for labels,
+                    (counts, total, count) in self.series.items()]
+        return OrderedDict((
+            ("description", self.description),
+            ("labels", list(self.labels)),
+            ("buckets", list(self.buckets)),
+            ("series", series),
+        ))
+
+    def merge(self, snapshot):
+        """Adds the values of a snapshot() of a histogram with the same
+        buckets."""
+        with self.lock:
+            for labels, counts, total, count in snapshot["series"]:
+                series = self.series.setdefault(tuple(labels),
+                        [[0] * len(self.buckets), 0.0, 0])
+                for i, n in enumerate(counts):
+                    series[0][i] += n
+                series[1] += total
+                series[2] += count
+
+    def render(self):
+        """Returns the histogram in the Prometheus text format."""
+        def format_labels(values, extra=()):
+            pairs = list(zip(self.labels, values)) + list(extra)
+            if not pairs:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace(
+                "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for name, value in pairs)
+
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels,
+                    (counts, total, count) in self.series.items()]
+
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(
+                    labels, [("le", repr(bound))]), cumulative))
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(labels,
+                [("le", "+Inf")]), count))
+            lines.append("%s_sum%s %r" % (self.name, format_labels(labels),
+                total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(labels),
+                count))
+        return "\n".join(lines) + "\n"
+
+_histograms = OrderedDict()
+_histograms_lock = threading.Lock()
+
+# Directory of the processes' values, see set_directory()
+_directory = None
+_dirty = False
+_flusher_pid = None
+_save_lock = threading.Lock()
+
+def histogram(name, description, labels=(), buckets=BUCKETS):
+    """Returns the histogram with the given name, registering it if needed."""
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, description, labels, buckets)
+        return _histograms[name]
+
+def set_directory(directory):
+    """Adds up the values of all processes sharing a directory.
+
+    Meant to be called in the parent process before it forks workers. Each
+    process saves its values to the directory within FLUSH_INTERVAL seconds
+    of observing them, and when it exits. The files of exited processes are
+    kept, so that the totals never decrease. Files left by an earlier run are
+    removed.
+    """
+    global _directory
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith(PREFIX):
+            os.remove(os.path.join(directory, name))
+    _directory = directory
+
+def _changed():
+    """Makes sure the values of this process are saved soon."""
+    global _dirty, _flusher_pid
+    if _directory is None:
+        return
+    _dirty = True
+    if _flusher_pid != os.getpid():
+        # The saving thread is started per process, since threads don't
+        # survive a fork
+        with _histograms_lock:
+            if _flusher_pid == os.getpid():
+                return
+            _flusher_pid = os.getpid()
+        threading.Thread(target=_flush, name="metrics", daemon=True).start()
+        atexit.register(_save)
+
+def _flush():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        if _dirty:
+            _save()
+
+def _save():
+    """Saves the values of this process to its file in the directory."""
+    global _dirty
+    _dirty = False
+    with _histograms_lock:
+        histograms = list(_histograms.values())
+    data = OrderedDict((h.name, h.snapshot()) for h in histograms)
+
+    filename = os.path.join(_directory, "%s%d.json" % (PREFIX, os.getpid()))
+    tmp = filename + ".tmp"
+    with _save_lock:
+        with open(tmp, "wt") as f:
+            json.dump(data, f)
+        os.replace(tmp, filename)
+
+def render():
+    """Returns all registered histograms in the Prometheus text format.
+
+    With a directory set, the values of all processes are added up.
+    """
+    with _histograms_lock:
+        histograms = list(_histograms.values())
+    if _directory is None:
+        return "".join(h.render() for h in histograms)
+
+    _save()
+    merged = OrderedDict((h.name, Histogram(h.name, h.description, h.labels,
+        h.buckets)) for h in histograms)
+    for name in sorted(os.listdir(_directory)):
+        if not (name.startswith(PREFIX) and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(_directory, name), "rt") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for histogram_name, snapshot in data.items():
+            if histogram_name not in merged:
+                merged[histogram_name] = Histogram(histogram_name,
+                        snapshot["description"], snapshot["labels"],
+                        snapshot["buckets"])
+            merged[histogram_name].merge(snapshot)
+    return "".join(h.render() for h in merged.values())
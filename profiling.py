@@ -0,0 +1,120 @@
+"""
+Profiles selected requests with cProfile.
+
+Every Nth request is profiled, and/or requests taking longer than a
+threshold. Catching slow requests means profiling all of them and only
+keeping the slow ones, which costs more. Each profile is written to its own
+.pstats file, named after the time, the route and the query, and only the
+newest ones are kept. Read them with e.g.
+
+    $ python3 -m pstats profiles/20170501T120000-123-search-freetext-horse.pstats
+"""
+
+import cProfile
+import contextlib
+import os
+import re
+import threading
+import time
+
+DIRECTORY = "profiles"
+
+class Profiler():
+    def __init__(self, directory=DIRECTORY, every=1, threshold=None, keep=100,
+            enabled=False):
+        """Initializes the profiler.
+
+        Args:
+            directory: Where to write the .pstats files.
+            every: Profile every Nth request, or none if 0.
+            threshold: Also keep profiles of requests taking at least this
+                many seconds, if not None.
+            keep: Number of newest profiles to keep.
+            enabled: Whether to profile at all, see set_enabled().
+        """
+        self.directory = directory
+        self.every = every
+        self.threshold = threshold
+        self.keep = keep
+        self.enabled = enabled
+        self.requests = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        # cProfile can't profile several threads at once, so concurrent
+        # requests are skipped while one is being profiled
+        self.busy = threading.Lock()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+
+    def status(self):
+        """Returns the settings and counters as a dictionary."""
+        return {
+            "enabled": self.enabled,
+            "every": self.every,
+            "threshold": self.threshold,
+            "directory": os.path.abspath(self.directory),
+            "keep": self.keep,
+            "requests": self.requests,
+            "written": self.written,
+        }
+
+    def _sampled(self):
+        with self.lock:
+            self.requests += 1
+            return self.every > 0 and self.requests % self.every == 0
+
+    @contextlib.contextmanager
+    def profile(self, route, query=None):
+        """Profiles the with block if it's selected.
+
+        Args:
+            route: Name of the route or operation, used in the file name.
+            query: Optional query string, also used in the file name.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        sampled = self._sampled()
+        if not (sampled or self.threshold is not None) or \
+                not self.busy.acquire(blocking=False):
+            yield
+            return
+
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+            elapsed = time.perf_counter() - started
+            if sampled or elapsed >= self.threshold:
+                self._write(profile, route, query)
+        finally:
+            self.busy.release()
+
+    def _write(self, profile, route, query):
+        os.makedirs(self.directory, exist_ok=True)
+        tags = [route] + ([query] if query else [])
+        tag = "-".join(re.sub(r"[^\w]+", "-", t).strip("-") for t in tags)
+        now = time.time()
+        filename = os.path.join(self.directory, "%s-%03d-%s.pstats" % (
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)),
+            int(now * 1000) % 1000, tag[:80] or "request"))
+        profile.dump_stats(filename)
+
+        with self.lock:
+            self.written += 1
+            self._rotate()
+
+    def _rotate(self):
+        profiles = sorted(f for f in os.listdir(self.directory)
+                if f.endswith(".pstats"))
+        for name in profiles[:max(0, len(profiles) - self.keep)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
@@ -6,28 +6,99 @@ Creates search indexes and performs search.
 
 import argparse
 import contextlib
+import fcntl
+import hashlib
+import os
 import shutil
 import sys
+import tarfile
 import tempfile
+import time
+
+# Written into restored indexes, to tell which snapshot they came from
+SNAPSHOT_ID = "SNAPSHOT"
 
 def get_engines():
     """Returns a dictionary of available search engines."""
     # Import engines here to make normal program startup faster
-    from engines import WhooshSearchEngine
+    from engines import MemorySearchEngine, WhooshSearchEngine
     return {
+        "memory": MemorySearchEngine,
         "whoosh": WhooshSearchEngine,
     }
 
-def get_engine(name, path, index):
+def get_engine(name, path, index, **options):
     """Initializes and returns named search engine.
 
     Args:
         path: Path to root of documents to index
         index: Path to the directory containing the index.
+        options: Engine specific keyword arguments, e.g. cache_size.
     """
     engines = get_engines()
     Engine = engines[name]
-    return Engine(path=path, index=index)
+    return Engine(path=path, index=index, **options)
+
+def snapshot_id(filename):
+    """Returns the SHA-1 digest of a snapshot file."""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_snapshot(index, filename):
+    """Writes the files of an index directory to a .tar.gz snapshot."""
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with tarfile.open(tmp, "w:gz") as tar:
+        for name in sorted(os.listdir(index)):
+            if name != SNAPSHOT_ID and not name.endswith(".tmp") and \
+                    not name.endswith("WRITELOCK"):
+                tar.add(os.path.join(index, name), arcname=name)
+    os.replace(tmp, filename)
+
+def restore_snapshot(filename, index):
+    """Replaces an index directory with a snapshot, unless it's already
+    restored from the same snapshot.
+
+    The snapshot is extracted next to the index and renamed into place, so
+    the index is never partially restored.
+
+    Returns:
+        True if the index was replaced.
+    """
+    identity = snapshot_id(filename)
+    try:
+        with open(os.path.join(index, SNAPSHOT_ID)) as f:
+            if f.read().strip() == identity:
+                return False
+    except FileNotFoundError:
+        pass
+
+    parent = os.path.dirname(os.path.abspath(index))
+    directory = tempfile.mkdtemp(prefix=".snapshot-", dir=parent)
+    try:
+        with tarfile.open(filename, "r:gz") as tar:
+            for member in tar.getmembers():
+                if not member.isfile() or os.path.basename(member.name) != \
+                        member.name:
+                    raise ValueError("Unexpected file in snapshot %s: %s" %
+                            (filename, member.name))
+            tar.extractall(directory)
+        with open(os.path.join(directory, SNAPSHOT_ID), "wt") as f:
+            f.write(identity + "\n")
+
+        old = None
+        if os.path.lexists(index):
+            old = "%s.old-%d" % (index.rstrip(os.sep), os.getpid())
+            os.rename(index, old)
+        os.rename(directory, index)
+        directory = old
+    finally:
+        if directory is not None:
+            remove_index(directory)
+    print("Restored index %s from %s" % (index, filename))
+    return True
 
 def parse_args():
     """Parses the command line arguments."""
@@ -51,6 +122,37 @@ def parse_args():
     p.add_argument("--suggest", "-s", metavar="QUERY", default=None,
         help="Print search suggestions for given query.")
 
+    p.add_argument("--update", "-u", default=False, action="store_true",
+        help="Incrementally update the index with changed documents.")
+
+    p.add_argument("--build", "-b", default=False, action="store_true",
+        help="Rebuild the index from scratch.")
+
+    p.add_argument("--procs", type=int, default=1,
+        help="Number of processes to use with --build.")
+
+    p.add_argument("--limitmb", type=int, default=128,
+        help="Memory limit in megabytes per process with --build.")
+
+    p.add_argument("--batchsize", type=int, default=100,
+        help="Number of rows handed to each process at a time with --build.")
+
+    p.add_argument("--rebuild", default=False, action="store_true",
+        help="Build a new version of the index next to the current one, "
+             "which keeps serving, then swap it in.")
+
+    p.add_argument("--keep", type=int, default=2,
+        help="Number of index versions kept by --rebuild.")
+
+    p.add_argument("--snapshot", type=str, default=None, metavar="FILE",
+        help="Write the index to a .tar.gz snapshot, e.g. after --build.")
+
+    p.add_argument("--profile", default=False, action="store_true",
+        help="Write a cProfile .pstats file for each operation.")
+
+    p.add_argument("--profile-dir", type=str, default="profiles",
+        help="Directory of the .pstats files with --profile.")
+
     opts = p.parse_args()
 
     if opts.list_engines:
@@ -62,29 +164,156 @@ def parse_args():
 def main():
     opts = parse_args()
 
+    from profiling import Profiler
+    profiler = Profiler(directory=opts.profile_dir, enabled=opts.profile)
+
     try:
+        if (opts.build or opts.rebuild) and \
+                not hasattr(get_engines()[opts.engine], "build"):
+            print("The %s engine has no index to build" % opts.engine)
+            sys.exit(1)
+
+        if opts.build:
+            Engine = get_engines()[opts.engine]
+            with profiler.profile("build"):
+                stats = Engine.build(opts.docs, opts.index,
+                        procs=opts.procs, limitmb=opts.limitmb,
+                        batchsize=opts.batchsize)
+            print("Built index %s: %d rows in %.2fs (%.0f rows/s)" % (
+                opts.index, stats["rows"], stats["seconds"],
+                stats["rows"] / max(stats["seconds"], 1e-9)))
+
+        if opts.rebuild:
+            with profiler.profile("rebuild"):
+                stats = rebuild_index(opts.engine, opts.docs, opts.index,
+                        keep=opts.keep, procs=opts.procs,
+                        limitmb=opts.limitmb, batchsize=opts.batchsize)
+            print("Swapped in index %s: %d rows in %.2fs" % (
+                stats["version"], stats["rows"], stats["seconds"]))
+
         engine = get_engine(opts.engine, opts.docs, opts.index)
     except KeyError as e:
         print("Unknown engine: %s" % e)
         sys.exit(1)
 
+    if opts.update:
+        with profiler.profile("update"):
+            stats = engine.update_index()
+        print("Updated index %s: %d added, %d updated, %d deleted, "
+              "%d unchanged in %.2fs" % (opts.index, stats["added"],
+                  stats["updated"], stats["deleted"], stats["unchanged"],
+                  stats["seconds"]))
+
+    if opts.snapshot is not None:
+        save_snapshot(opts.index, opts.snapshot)
+        print("Wrote snapshot of %s to %s" % (opts.index, opts.snapshot))
+
     if opts.query is not None:
-        for results in engine.search(opts.query):
-            print(results)
+        with profiler.profile("search", opts.query):
+            batches = list(engine.search(opts.query))
+        for results in batches:
+            print("%d results for %r" % (len(results), opts.query))
             for result in results:
                 print(result)
 
     if opts.suggest is not None:
-        for phrase in engine.suggest(opts.suggest):
+        with profiler.profile("suggest", opts.suggest):
+            suggestions = engine.suggest(opts.suggest)
+        for phrase in suggestions:
             print(phrase)
 
+    if opts.profile:
+        print("Wrote %d profiles to %s" % (profiler.written, opts.profile_dir))
+
 @contextlib.contextmanager
-def tempdir():
-    directory = tempfile.mkdtemp()
+def tempdir(**options):
+    """Yields a new temporary directory, removed afterwards unless it has
+    been moved away.
+
+    Args:
+        options: Keyword arguments of tempfile.mkdtemp(), e.g. dir.
+    """
+    directory = tempfile.mkdtemp(**options)
     try:
         yield directory
     finally:
-        shutil.rmtree(directory)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+
+def remove_index(path):
+    """Removes an index directory, or only the symlink if it's one."""
+    if os.path.islink(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+def swap_symlink(target, link):
+    """Atomically points link to target, replacing what link was."""
+    tmp = os.path.join(os.path.dirname(link), ".%s.%d.tmp" % (
+        os.path.basename(link), os.getpid()))
+    os.symlink(os.path.relpath(target, os.path.dirname(link)), tmp)
+    os.replace(tmp, link)
+
+def rebuild_index(name, path, index, keep=2, **options):
+    """Builds a new index while the current one keeps serving, then swaps it
+    in.
+
+    Versions of the index live in "<index>.versions/", and index itself is a
+    symlink to the current one. The new version is built in a staging
+    directory there and renamed, then the symlink is replaced atomically.
+    Running engines pick up the new version on their next query. The oldest
+    versions are removed, keeping the given number, so that readers still
+    using the previous version can finish.
+
+    Args:
+        name: Name of the search engine.
+        path: Path to the documents.
+        index: Path of the index symlink.
+        keep: Number of versions to keep, including the new one.
+        options: Keyword arguments of the engine's build().
+
+    Returns:
+        The dictionary returned by build(), with the new "version" directory.
+    """
+    Engine = get_engines()[name]
+    if not hasattr(Engine, "build"):
+        raise ValueError("The %s engine has no index to rebuild" % name)
+
+    index = index.rstrip(os.sep)
+    versions = index + ".versions"
+    os.makedirs(versions, exist_ok=True)
+
+    # Only one rebuild at a time, also across processes
+    with open(os.path.join(versions, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            version = os.path.join(versions, time.strftime("%Y%m%dT%H%M%S"))
+            with tempdir(prefix=".staging-", dir=versions) as staging:
+                stats = Engine.build(path, staging, **options)
+                while os.path.exists(version):
+                    version += "-1"
+                os.rename(staging, version)
+
+            if os.path.isdir(index) and not os.path.islink(index):
+                # The first rebuild moves the original index under versions,
+                # so the symlink can take its place
+                os.rename(index, os.path.join(versions, "original"))
+            swap_symlink(version, index)
+
+            current = os.path.basename(version)
+            old = sorted((d for d in os.listdir(versions) if not
+                d.startswith(".") and d != current), key=lambda d:
+                os.path.getmtime(os.path.join(versions, d)))
+            for directory in old[:max(0, len(old) - keep + 1)]:
+                shutil.rmtree(os.path.join(versions, directory),
+                        ignore_errors=True)
+        finally:
+            # Processes forked meanwhile, e.g. gunicorn workers, share the
+            # lock, so closing it isn't enough to release it
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    stats["version"] = os.path.abspath(version)
+    return stats
 
 if __name__ == "__main__":
     if sys.version_info[0] <= 2:
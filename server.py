@@ -6,6 +6,8 @@ Starts a webserver on your local machine.
 
 from flask import (
     Flask,
+    Response,
+    g,
     render_template,
     make_response,
     request,
@@ -14,19 +16,34 @@ from flask import (
     url_for
 )
 
+import analytics # local
+import heatmaps # local
+import metrics # local
+import profiling # local
 import search # local
 import argparse
+import atexit
+import contextlib
+import csv
+import datetime
+import hmac
+import io
 import json
 import os
 import random
+import shutil
 import sys
+import tempfile
+import threading
+import time
 # replace with something more robust if necessary
 import pickle
 
 from user_data import (
         get_user_data,
         save_user_data,
-        get_all_users)
+        get_all_users,
+        iter_tasks)
 
 def parse_arguments():
     """Fetches and verifies command line arguments."""
@@ -50,6 +67,62 @@ def parse_arguments():
     p.add_argument("--engine", type=str, default="whoosh",
         help="Which search engine to use")
 
+    p.add_argument("--cache-size", type=int, default=1024,
+        help="Maximum number of cached query results, 0 disables the cache")
+
+    p.add_argument("--cache-ttl", type=float, default=300,
+        help="Number of seconds query results are cached")
+
+    p.add_argument("--searchers", type=int, default=4,
+        help="Maximum number of index searchers shared by request threads")
+
+    p.add_argument("--page-size", type=int, default=20,
+        help="Number of search results per page")
+
+    p.add_argument("--workers", type=int, default=0,
+        help="Number of preforked worker processes served by gunicorn, "
+             "0 runs Flask's development server")
+
+    p.add_argument("--threads", type=int, default=4,
+        help="Number of request threads per worker process")
+
+    p.add_argument("--metrics-dir", type=str, default=None,
+        help="Directory where workers save their /metrics histograms to be "
+             "added up, default a temporary directory")
+
+    p.add_argument("--lazy", default=False, action="store_true",
+        help="Start serving at once and load the search engine in the "
+             "background, answering search requests with 503 until then")
+
+    p.add_argument("--index-snapshot", type=str, default=None,
+        help="Restore the index from this .tar.gz snapshot at startup, "
+             "unless it's already restored")
+
+    p.add_argument("--no-build", default=False, action="store_true",
+        help="Fail instead of building a missing or outdated index")
+
+    p.add_argument("--profile", default=False, action="store_true",
+        help="Profile requests with cProfile, see also POST /profile")
+
+    p.add_argument("--profile-every", type=int, default=None,
+        help="Profile every Nth request (default 1, or 0 with "
+             "--profile-threshold)")
+
+    p.add_argument("--profile-threshold", type=float, default=None,
+        help="Also keep profiles of requests taking at least this many "
+             "milliseconds")
+
+    p.add_argument("--profile-dir", type=str, default=profiling.DIRECTORY,
+        help="Directory of the .pstats files")
+
+    p.add_argument("--profile-keep", type=int, default=100,
+        help="Number of newest .pstats files to keep")
+
+    p.add_argument("--admin-token", type=str,
+        default=os.environ.get("VLE_ADMIN_TOKEN"),
+        help="Token required to POST to /analytics, /profile and /rebuild, "
+             "default $VLE_ADMIN_TOKEN; without one, they're disabled")
+
     p.add_argument("--list-engines", default=False, action="store_true",
         help="List available search engines")
 
@@ -59,6 +132,9 @@ def parse_arguments():
         print(" ".join(search.get_engines()))
         sys.exit(0)
 
+    if options.profile_every is None:
+        options.profile_every = 1 if options.profile_threshold is None else 0
+
     if options.templates is None:
         options.templates = os.path.realpath(
                 os.path.join(os.path.dirname(__file__), "templates"))
@@ -75,57 +151,193 @@ def parse_arguments():
 
     return options
 
+REQUEST_SECONDS = metrics.histogram("vle_request_seconds",
+        "Time spent handling requests.", ("route", "method", "status"))
+
+def format_children(children):
+    """Formats one level of the category tree for JSON."""
+    return [{"name": name, "link": value} if isinstance(value, str)
+            else {"name": name, "count": value} for name, value in children]
+
 class SearchApp(Flask):
-    def __init__(self, *args, search_engine_name=None, corpus=None, **kw):
+    # Views that can't be served before the search engine is loaded
+    ENGINE_ENDPOINTS = {"cache_view", "navigation", "navigation_children",
+            "results_view", "search", "search_suggest", "search_suggestions"}
+
+    # Views whose POST recomputes data or changes the server's settings, so
+    # they require the admin token
+    ADMIN_ENDPOINTS = {"analytics_view", "profile_view", "rebuild_view"}
+
+    # Seconds clients are asked to wait while the search engine loads
+    RETRY_AFTER = 5
+
+    def __init__(self, *args, search_engine_name=None, corpus=None,
+            engine_options=None, page_size=20, profiler=None, lazy=False,
+            index_snapshot=None, admin_token=None, **kw):
         super().__init__(*args, **kw)
         self._setup_routes()
+        self.before_request(self._start_timer)
+        self.after_request(self._stop_timer)
+        self.before_request(self._start_profile)
+        self.teardown_request(self._stop_profile)
+        self.before_request(self._require_engine)
+        self.before_request(self._require_admin)
+        self.profiler = profiler or profiling.Profiler()
         self.corpus = corpus
         self.corpus_path = os.path.realpath(os.path.join(os.path.dirname(__file__),
             "corpora", self.corpus))
 
-        self.index_path = os.path.realpath( os.path.join(
-            os.path.dirname(__file__), "indexes", self.corpus))
+        # Not resolved, since the index may be a symlink that's swapped by a
+        # rebuild
+        self.index_path = os.path.join(os.path.realpath(os.path.join(
+            os.path.dirname(__file__), "indexes")), self.corpus)
 
-        self.search_engine = search.get_engine(search_engine_name,
-                path=self.corpus_path, index=self.index_path)
+        self.search_engine_name = search_engine_name
+        self.engine_options = engine_options or {}
+        self.index_snapshot = index_snapshot
+        self.admin_token = admin_token
+        self.engine_error = None
+        self.rebuild_status = {"running": False}
+        self.rebuild_lock = threading.Lock()
 
         self.secret_key = "asdfasdfasdfasd"
+        self.page_size = page_size
+        self.ready = False
+
+        if lazy:
+            self.search_engine = None
+            threading.Thread(target=self._load_engine, name="engine-loader",
+                    daemon=True).start()
+        else:
+            self.search_engine = self._create_engine()
+
+    def _create_engine(self):
+        if self.index_snapshot is not None:
+            search.restore_snapshot(self.index_snapshot, self.index_path)
+        return search.get_engine(self.search_engine_name,
+                path=self.corpus_path, index=self.index_path,
+                **self.engine_options)
+
+    def _load_engine(self):
+        """Creates and warms up the search engine, then starts using it."""
+        started = time.time()
+        while True:
+            try:
+                engine = self._create_engine()
+                if hasattr(engine, "warm_up"):
+                    engine.warm_up()
+                break
+            except FileNotFoundError as e:
+                # The index may still be built, e.g. by the gunicorn master
+                self.engine_error = "%s: %s" % (type(e).__name__, e)
+                time.sleep(self.RETRY_AFTER)
+            except Exception as e:
+                self.engine_error = "%s: %s" % (type(e).__name__, e)
+                self.logger.exception("Could not load the search engine")
+                return
+        self.engine_error = None
+        self.search_engine = engine
+        self.ready = True
+        print("Worker %d loaded the search engine in %.2fs" % (os.getpid(),
+            time.time() - started))
+
+    def _require_engine(self):
+        if self.search_engine is None and \
+                request.endpoint in self.ENGINE_ENDPOINTS:
+            response = make_response(json.dumps({"ready": False,
+                "error": self.engine_error}), 503)
+            response.headers["Retry-After"] = str(self.RETRY_AFTER)
+            return response
+
+    def _require_admin(self):
+        """Rejects POSTs to the admin views without the admin token.
+
+        The token is given in the X-Admin-Token header or the "token" form
+        field. Without a configured token, the POSTs are always rejected.
+        """
+        if request.method != "POST" or \
+                request.endpoint not in self.ADMIN_ENDPOINTS:
+            return None
+        if not self.admin_token:
+            return make_response("Error: Admin views are disabled, start the "
+                    "server with --admin-token", 403)
+        token = request.headers.get("X-Admin-Token",
+                request.form.get("token", ""))
+        if not hmac.compare_digest(token.encode("utf-8"),
+                self.admin_token.encode("utf-8")):
+            return make_response("Error: Invalid admin token", 403)
 
     def _setup_routes(self):
         route = lambda *args, **kw: self.add_url_rule(*args, **kw)
         route("/", view_func=self.index)
+        route("/analytics", view_func=self.analytics_view, methods=["GET", "POST"])
         route("/autocomplete", view_func=self.search_suggestions)
+        route("/cache", view_func=self.cache_view)
         route("/doc/<path:filename>", view_func=self.show_doc)
+        route("/heatmap", view_func=self.heatmap_view)
         route("/dump", view_func=self.test_results_dump_view, methods=["GET", "POST"]) # alias: test_results_dump
+        route("/export", view_func=self.test_results_export_view)
         route("/licenses", view_func=self.licenses)
+        route("/metrics", view_func=self.metrics_view)
+        route("/profile", view_func=self.profile_view, methods=["GET", "POST"])
+        route("/ready", view_func=self.ready_view)
+        route("/rebuild", view_func=self.rebuild_view, methods=["GET", "POST"])
         route("/login", view_func=self.login, methods=["GET", "POST"])
         route("/logout", view_func=self.logout)
         route("/search/finalizer", view_func=self.finalizer_view, methods=["GET", "POST"])
         route("/search/freetext", view_func=self.search, methods=["GET", "POST"])
         route("/search/navigation", view_func=self.navigation, methods=["GET", "POST"])
+        route("/search/navigation/children", view_func=self.navigation_children)
         route("/search/results", view_func=self.results_view, methods=["GET", "POST"])
         route("/search/suggestions", view_func=self.search_suggest, methods=["GET", "POST"])
         route("/test_results_dump", view_func=self.test_results_dump_view, methods=["GET", "POST"])
 
+    def warm_up(self):
+        """Prepares the search engine before serving, then marks the app
+        as ready."""
+        started = time.time()
+        if hasattr(self.search_engine, "warm_up"):
+            self.search_engine.warm_up()
+        self.ready = True
+        print("Worker %d warmed up in %.2fs" % (os.getpid(),
+            time.time() - started))
+
+    def _start_timer(self):
+        g.started = time.perf_counter()
+
+    def _stop_timer(self, response):
+        """Records the request time per route pattern, not per URL."""
+        if "started" in g:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_SECONDS.observe(time.perf_counter() - g.started, route,
+                    request.method, response.status_code)
+        return response
+
+    def _start_profile(self):
+        g.profile = contextlib.ExitStack()
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.profile.enter_context(self.profiler.profile(route,
+            request.values.get("query")))
+
+    def _stop_profile(self, exception):
+        if "profile" in g:
+            g.profile.close()
+
     def show_doc(self, filename):
         """Renders a document in the current corpus."""
         if "userid" not in session:
            return redirect(url_for('login'))
-        doc = os.path.relpath(os.path.join(self.corpus_path, filename))
-
-        # Prevent access of documents outside corpora folder
-        if not os.path.realpath(doc).startswith(
-                os.path.realpath(self.corpus_path)):
-            raise RuntimeError("Can only view docs within corpus path: %s" %
-                    doc)
+        doc = os.path.realpath(os.path.join(self.corpus_path, filename))
 
-        if doc.startswith(".."):
+        # Prevent access of documents outside corpora folder. Checked on
+        # the resolved path, so it works from any working directory.
+        if os.path.commonpath([doc, self.corpus_path]) != self.corpus_path:
             return "Error: Trying to access file outside of corpus path"
 
-        if not os.path.exists(doc):
+        if not os.path.isfile(doc):
             return "Error: File not found: %s" % filename
 
-        with open(doc, "rt") as f:
+        with open(doc, "rt", encoding="utf-8", errors="replace") as f:
             content = f.read()
             context = {
                 "title": os.path.basename(doc),
@@ -147,6 +359,106 @@ class SearchApp(Flask):
 
         return json.dumps(result)
 
+    def analytics_view(self):
+        """Returns the aggregates per task id and view as JSON.
+
+        POSTing recomputes them from all finished tasks first, which
+        requires the admin token.
+        """
+        if request.method == "POST":
+            analytics.rebuild_analytics()
+        return json.dumps(analytics.get_analytics())
+
+    def heatmap_view(self):
+        """Returns a heatmap of click and key press positions as JSON.
+
+        It's in the {max, data} format of heatmap.js' setData(), for the
+        events of the optional "task" id or "view" argument.
+        """
+        heatmap = heatmaps.get_heatmaps().heatmap(
+                task_id=request.args.get("task", None, type=int),
+                view=request.args.get("view", None))
+        return json.dumps(heatmap)
+
+    def metrics_view(self):
+        """Returns the request, search engine and user data timings.
+
+        They're histograms in the Prometheus text format, for scraping, so
+        no session is required.
+        """
+        return Response(metrics.render(),
+                mimetype="text/plain; version=0.0.4")
+
+    def profile_view(self):
+        """Returns the profiler settings and counters as JSON.
+
+        POSTing "enabled" (1 or 0), "every" or "threshold" (milliseconds,
+        empty for none) changes them at runtime, with the admin token.
+        """
+        if request.method == "POST":
+            try:
+                every = max(0, int(request.form.get("every",
+                    self.profiler.every)))
+                threshold = request.form.get("threshold", None)
+                if threshold is None:
+                    threshold = self.profiler.threshold
+                else:
+                    threshold = float(threshold) / 1000 if threshold else None
+            except ValueError as e:
+                return make_response("Error: Invalid argument: %s" % e, 400)
+
+            self.profiler.every = every
+            self.profiler.threshold = threshold
+            if "enabled" in request.form:
+                self.profiler.set_enabled(request.form["enabled"].lower()
+                        in ("1", "true", "on", "yes"))
+        return json.dumps(self.profiler.status())
+
+    def _rebuild(self):
+        started = time.time()
+        try:
+            stats = search.rebuild_index(self.search_engine_name,
+                    self.corpus_path, self.index_path)
+            status = {"running": False, "version": stats["version"],
+                    "rows": stats["rows"]}
+        except Exception as e:
+            self.logger.exception("Could not rebuild the index")
+            status = {"running": False, "error": "%s: %s" % (
+                type(e).__name__, e)}
+        status["seconds"] = time.time() - started
+        self.rebuild_status = status
+
+    def rebuild_view(self):
+        """Rebuilds the index without interrupting searches.
+
+        POSTing starts building a new version of the index in the background,
+        which is swapped in when done; see search.rebuild_index(). Running
+        workers pick it up by themselves. POSTing requires the admin token.
+        Returns the status of the last rebuild as JSON.
+        """
+        if request.method == "POST":
+            with self.rebuild_lock:
+                if self.rebuild_status["running"]:
+                    return make_response(json.dumps(self.rebuild_status), 409)
+                self.rebuild_status = {"running": True}
+                threading.Thread(target=self._rebuild, name="rebuild",
+                        daemon=True).start()
+            return make_response(json.dumps(self.rebuild_status), 202)
+        return json.dumps(self.rebuild_status)
+
+    def ready_view(self):
+        """Returns 200 once the app has warmed up, 503 before."""
+        response = make_response(json.dumps({"ready": self.ready,
+            "pid": os.getpid(), "error": self.engine_error}),
+            200 if self.ready else 503)
+        if not self.ready:
+            response.headers["Retry-After"] = str(self.RETRY_AFTER)
+        return response
+
+    def cache_view(self):
+        """Returns the query cache counters of the search engine as JSON."""
+        return json.dumps(self.search_engine.cache.stats())
+
     def finalizer_view(self):
         """Performs the actual search."""
         if "userid" not in session:
@@ -199,6 +511,70 @@ class SearchApp(Flask):
 
         return make_response("<br>".join(output))
 
+    def test_results_export_view(self):
+        """Streams the test data as CSV or TSV, one task per row.
+
+        Query arguments:
+            format: "csv" (default) or "tsv".
+            task: Only export tasks with this id.
+            view: Only export tasks of this view, e.g. "navigation".
+            since: Only export tasks last updated on or after this date
+                (YYYY-MM-DD, UTC).
+            until: Only export tasks last updated on or before this date.
+        """
+
+        def parse_date(name, days=0):
+            value = request.args.get(name)
+            if value is None:
+                return None
+            date = datetime.datetime.strptime(value, "%Y-%m-%d").replace(
+                    tzinfo=datetime.timezone.utc)
+            return (date + datetime.timedelta(days=days)).timestamp()
+
+        try:
+            delimiter = {"csv": ",", "tsv": "\t"}[request.args.get("format",
+                "csv")]
+            since = parse_date("since")
+            until = parse_date("until", days=1)
+        except (KeyError, ValueError) as e:
+            return make_response("Error: Invalid argument: %s" % e, 400)
+
+        filters = {
+            "task_id": request.args.get("task", None, type=int),
+            "view": request.args.get("view", None),
+            "since": since,
+            "until": until,
+        }
+
+        def rows():
+            line = io.StringIO()
+            writer = csv.writer(line, delimiter=delimiter)
+
+            def format_row(fields):
+                line.seek(0)
+                line.truncate()
+                writer.writerow(fields)
+                return line.getvalue()
+
+            yield format_row(["userid", "index", "task id", "view",
+                "task text", "clicks", "time", "success", "completed",
+                "updated"])
+
+            for userid, index, task in iter_tasks(**filters):
+                updated = ""
+                if task.updated is not None:
+                    updated = datetime.datetime.fromtimestamp(task.updated,
+                            datetime.timezone.utc).isoformat()
+                yield format_row([userid, index, task.get_id(), task.view,
+                    task.text, task.number_of_clicks(), task.time_elapsed(),
+                    task.success(), task.is_finished(), updated])
+
+        mimetype = "text/csv" if delimiter == "," else \
+                "text/tab-separated-values"
+        return Response(rows(), mimetype=mimetype, headers={
+            "Content-Disposition": "attachment; filename=test_results.%s" %
+                request.args.get("format", "csv")})
+
     def results_view(self):
         """Performs the actual search."""
         if "userid" not in session:
@@ -239,9 +615,35 @@ class SearchApp(Flask):
             "task": task,
         }
 
-        context["categories"] = self.search_engine.category_tree()
+        context["categories"] = format_children(
+                self.search_engine.category_children([]))
         return make_response(render_template("navigation.html", **context))
 
+    def navigation_children(self):
+        """Returns one level of the category tree as JSON.
+
+        The level is given by repeated "path" arguments, one for each category
+        name leading to it. Subcategories have a child count, while documents
+        have a link.
+        """
+        if "userid" not in session:
+           return redirect(url_for('login'))
+
+        path = request.args.getlist("path")
+
+        try:
+            children = self.search_engine.category_children(path)
+        except KeyError:
+            return make_response(json.dumps({"error": "No such category",
+                "path": path}), 404)
+
+        result = {
+            "path": path,
+            "children": format_children(children),
+        }
+
+        return json.dumps(result)
+
     def search_suggest(self):
         """Performs the actual suggestions-assisted search."""
         if "userid" not in session:
@@ -268,17 +670,9 @@ class SearchApp(Flask):
         if perform_search:
             self.logger.info("Search: %s" % repr(query))
 
-            results = []
-            for hits in self.search_engine.search(query):
-                for hit in hits:
-                    score = hit.score
-                    url = "%s" % hit["link"]
-                    title = hit["name"]
-                    description = hit["description"]
-                    category = hit["category"]
-                    results.append((score, url, title, description, category))
-
-            context["results"] = sorted(results, reverse=True)
+            page = request.form.get("page", 1, type=int)
+            context["results"] = self.search_engine.search_page(query,
+                    page=page, pagesize=self.page_size)
 
         return make_response(render_template("search.html", **context))
 
@@ -307,17 +701,9 @@ class SearchApp(Flask):
         if perform_search:
             self.logger.info("Search: %s" % repr(query))
 
-            results = []
-            for hits in self.search_engine.search(query):
-                for hit in hits:
-                    score = hit.score
-                    url = "%s" % hit["link"]
-                    title = hit["name"]
-                    description = hit["description"]
-                    category = hit["category"]
-                    results.append((score, url, title, description, category))
-
-            context["results"] = sorted(results, reverse=True)
+            page = request.form.get("page", 1, type=int)
+            context["results"] = self.search_engine.search_page(query,
+                    page=page, pagesize=self.page_size)
 
         return make_response(render_template("search.html", **context))
 
@@ -368,12 +754,110 @@ class SearchApp(Flask):
         }
         return make_response(render_template("licenses.html", **context))
 
+def make_app(options):
+    """Returns a SearchApp configured by the command line options."""
+    engine_options = {
+        "cache_size": options.cache_size,
+        "cache_ttl": options.cache_ttl,
+        "searchers": options.searchers,
+    }
+    if options.no_build:
+        engine_options["build_missing"] = False
+
+    profiler = profiling.Profiler(directory=options.profile_dir,
+            every=options.profile_every, threshold=None if
+            options.profile_threshold is None else
+            options.profile_threshold / 1000, keep=options.profile_keep,
+            enabled=options.profile)
+
+    return SearchApp(__name__, search_engine_name=options.engine,
+            corpus=options.corpus, engine_options=engine_options,
+            page_size=options.page_size, profiler=profiler,
+            lazy=options.lazy, index_snapshot=options.index_snapshot,
+            admin_token=options.admin_token,
+            template_folder=options.templates)
+
+def run_workers(options):
+    """Serves the app from preforked gunicorn worker processes.
+
+    The app is created in each worker after the fork, so that workers don't
+    share open index files, and warmed up before the worker takes requests.
+    """
+    import gunicorn.app.base
+
+    class Server(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "%s:%d" % (options.host, options.port))
+            self.cfg.set("workers", options.workers)
+            self.cfg.set("threads", options.threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", False)
+
+        def load(self):
+            app = make_app(worker_options)
+            if not options.lazy:
+                app.warm_up()
+            return app
+
+    root = os.path.dirname(__file__)
+    index = os.path.join(os.path.realpath(os.path.join(root, "indexes")),
+            options.corpus)
+    if options.index_snapshot is not None:
+        search.restore_snapshot(options.index_snapshot, index)
+
+    # Builds or upgrades the index once, instead of in every worker. It's
+    # built as a new version and swapped in whole, so lazy workers never open
+    # it half built. They start serving at once and answer 503 until it's
+    # there, so then it's built in the background while gunicorn binds.
+    Engine = search.get_engines()[options.engine]
+    if not options.no_build and hasattr(Engine, "build"):
+        corpus = os.path.realpath(os.path.join(root, "corpora",
+            options.corpus))
+
+        def build():
+            try:
+                Engine(path=corpus, index=index, build_missing=False).close()
+            except FileNotFoundError:
+                stats = search.rebuild_index(options.engine, corpus, index)
+                print("Built index %s: %d rows in %.2fs" % (
+                    stats["version"], stats["rows"], stats["seconds"]))
+
+        if options.lazy:
+            threading.Thread(target=build, name="index-builder",
+                    daemon=True).start()
+        else:
+            build()
+
+    # The workers only open the index the master has made sure exists
+    worker_options = argparse.Namespace(**vars(options))
+    worker_options.no_build = True
+
+    # Each worker saves its histograms there, so that /metrics reports the
+    # totals of all workers, whichever one is scraped
+    directory = options.metrics_dir
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="vle-metrics-")
+        master = os.getpid()
+
+        def remove():
+            # The workers inherit the handler, but must leave it
+            if os.getpid() == master:
+                shutil.rmtree(directory, ignore_errors=True)
+        atexit.register(remove)
+    metrics.set_directory(directory)
+
+    Server().run()
+
 def main():
     options = parse_arguments()
 
-    app = SearchApp(__name__, search_engine_name=options.engine,
-            corpus=options.corpus, template_folder=options.templates)
-    app.run(host=options.host, port=options.port)
+    if options.workers > 0:
+        run_workers(options)
+    else:
+        app = make_app(options)
+        if not options.lazy:
+            app.warm_up()
+        app.run(host=options.host, port=options.port, threaded=True)
 
 if __name__ == "__main__":
     if sys.version_info[0] <= 2:
@@ -1,36 +1,333 @@
+"""
+Stores the users' test tasks in SQLite.
+
+The database runs in WAL mode, so that readers don't block the writer, and
+changes are written as row-level inserts and updates. The interaction
+statistics themselves go to the append-only event log, while the tasks keep
+running totals of them. Concurrent requests for the same user therefore add
+to the totals instead of overwriting each other.
+"""
+
+from event_log import get_event_log
+import argparse
+import metrics
 import os
 import pickle
 import hashlib
+import sqlite3
+import threading
+import time
+
+DATABASE = os.path.join("user_data", "user_data.sqlite3")
+
+USER_DATA_SECONDS = metrics.histogram("vle_user_data_seconds",
+        "Time spent loading and saving user data.", ("operation",))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    userid TEXT PRIMARY KEY,
+    current_task INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    userid TEXT NOT NULL REFERENCES users(userid),
+    position INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    link TEXT NOT NULL,
+    view TEXT NOT NULL,
+    link_found TEXT,
+    active INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    first_timestamp REAL,
+    last_timestamp REAL,
+    updated REAL,
+    elapsed REAL,
+    PRIMARY KEY (userid, position)
+);
+
+-- Aggregates of finished tasks, grouped by "task" id or by "view"
+CREATE TABLE IF NOT EXISTS analytics (
+    grouping TEXT NOT NULL,
+    key TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    total_time REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (grouping, key)
+);
+"""
+
+# Created after the added columns, since they index the elapsed column. The
+# times are in order within each task id and view, so their medians are read
+# from the middle of the index.
+INDEXES = """
+DROP INDEX IF EXISTS tasks_finished_id;
+DROP INDEX IF EXISTS tasks_finished_view;
+CREATE INDEX IF NOT EXISTS tasks_finished_id_elapsed
+    ON tasks (finished, id, elapsed);
+CREATE INDEX IF NOT EXISTS tasks_finished_view_elapsed
+    ON tasks (finished, view, elapsed);
+"""
+
+# The same as Task.time_elapsed() and Task.success() for rows of tasks
+TIME_ELAPSED_SQL = """CASE WHEN clicks < 2 THEN 0
+    ELSE COALESCE(last_timestamp - first_timestamp, 0) END"""
+SUCCESS_SQL = "COALESCE(link = link_found, 0)"
+
+# Columns missing from tables created by older versions
+ADDED_COLUMNS = (
+    ("tasks", "clicks", "INTEGER NOT NULL DEFAULT 0"),
+    ("tasks", "first_timestamp", "REAL"),
+    ("tasks", "last_timestamp", "REAL"),
+    ("tasks", "updated", "REAL"),
+    ("tasks", "elapsed", "REAL"),
+)
+
+TASK_COLUMNS = """id, name, text, link, view, link_found, active, finished,
+    clicks, first_timestamp, last_timestamp, updated"""
+
+_local = threading.local()
 
 def sha1hex(s):
     return hashlib.sha1(s).hexdigest()
 
 def get_filename(userid):
+    """Returns the name of the pickle file formerly used for a user."""
     sanitized = sha1hex(userid.encode("utf-8")) # don't *ever* do otherwise
     return os.path.join("user_data", "data_{}.db".format(sanitized))
 
+def get_connection():
+    """Returns the database connection of the current thread and process."""
+    pid, connection = getattr(_local, "connection", (None, None))
+    if pid != os.getpid():
+        connection = sqlite3.connect(DATABASE, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        _add_columns(connection)
+        connection.executescript(INDEXES)
+        _local.connection = (os.getpid(), connection)
+    return connection
+
+def _add_columns(connection):
+    with connection:
+        for table, column, definition in ADDED_COLUMNS:
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(%s)" % table)]
+            if column not in columns:
+                connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    table, column, definition))
+                if column == "elapsed":
+                    # Times of the tasks finished before the column existed
+                    connection.execute("""UPDATE tasks SET elapsed = %s
+                        WHERE finished = 1""" % TIME_ELAPSED_SQL)
+
+def _load_user(connection, userid, current_task):
+    user = UserData.__new__(UserData)
+    user.userid = userid
+    user.current_task = current_task
+    user._saved_current_task = current_task
+    user._completed = []
+    user.tasks = []
+
+    for row in connection.execute("""SELECT %s FROM tasks WHERE userid = ?
+            ORDER BY position""" % TASK_COLUMNS, (userid,)):
+        user.tasks.append(_load_task(row))
+
+    return user
+
+def _load_task(row):
+    task = Task(*row[:5])
+    task.link_found = row[5]
+    task.active = bool(row[6])
+    task.finished = bool(row[7])
+    (task.clicks, task.first_timestamp, task.last_timestamp,
+            task.updated) = row[8:12]
+    task._saved_state = task._state()
+    return task
+
+@USER_DATA_SECONDS.time("load")
 def get_user_data(userid):
-    filename = get_filename(userid)
-    if not os.path.exists(filename):
+    connection = get_connection()
+    row = connection.execute("SELECT current_task FROM users WHERE userid = ?",
+            (userid,)).fetchone()
+    if row is None:
         return UserData(userid)
+    return _load_user(connection, userid, row[0])
 
-    with open(filename, "rb+") as f:
-        return pickle.load(f)
-
+@USER_DATA_SECONDS.time("save")
 def save_user_data(data):
-    filename = get_filename(data.userid)
-    with open(filename, "wb+") as f:
-        pickle.dump(data, f)
+    """Writes the changes made to a user since it was loaded."""
+    connection = get_connection()
+    now = time.time()
+    logged = []
+    with connection:
+        connection.execute("""INSERT OR IGNORE INTO users (userid,
+            current_task) VALUES (?, ?)""", (data.userid, data.current_task))
+        if data.current_task != getattr(data, "_saved_current_task", None):
+            connection.execute("""UPDATE users SET current_task = ?
+                WHERE userid = ?""", (data.current_task, data.userid))
+        data._saved_current_task = data.current_task
+
+        pending = set(getattr(data, "_completed", ()))
+        data._completed = []
+
+        for position, task in enumerate(data.tasks):
+            state = task._state()
+            saved_state = getattr(task, "_saved_state", None)
+            if saved_state is None:
+                # Tasks finished before their first save are inserted as
+                # unfinished, so that they're counted as completed below
+                connection.execute("""INSERT OR IGNORE INTO tasks (userid,
+                    position, id, name, text, link, view, link_found, active,
+                    finished, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                    ?)""", (data.userid, position, task.id, task.name,
+                        task.text, task.link, task.view) + state[:2] +
+                    (0 if position in pending else state[2], now))
+
+            # Only counts the task if no other request finished it already
+            completed = position in pending and connection.execute(
+                """UPDATE tasks SET finished = 1 WHERE userid = ? AND
+                position = ? AND finished = 0""",
+                (data.userid, position)).rowcount > 0
+
+            if state != saved_state:
+                connection.execute("""UPDATE tasks SET link_found = ?,
+                    active = ?, finished = ?, updated = ? WHERE userid = ?
+                    AND position = ?""", state + (now, data.userid,
+                        position))
+            task._saved_state = state
+
+            # Only events appended since loading are in memory
+            events = task.stats[getattr(task, "_saved_stats", 0):]
+            if events:
+                # Concurrent saves can commit in any order, so the first and
+                # last timestamps only ever move outwards
+                first, last = event_time_range(events)
+                connection.execute("""UPDATE tasks SET clicks = clicks + ?,
+                    first_timestamp = COALESCE(MIN(first_timestamp, ?),
+                        first_timestamp, ?),
+                    last_timestamp = COALESCE(MAX(last_timestamp, ?),
+                        last_timestamp, ?),
+                    updated = ? WHERE userid = ? AND position = ?""", (
+                        len(events), first, first, last, last, now,
+                        data.userid, position))
+                logged.extend(dict(event, userid=data.userid,
+                    task_id=task.id, position=position, view=task.view,
+                    received=now) for event in events)
+            task._saved_stats = len(task.stats)
+
+            if completed:
+                _add_to_analytics(connection, data.userid, position)
+
+    # Only logged once committed, so a rolled back save doesn't leave the
+    # log ahead of the totals
+    if logged:
+        get_event_log().append(logged)
+
+def event_time_range(events):
+    """Returns the earliest and latest timestamps of stats events.
+
+    Events without a timestamp still count as clicks, but are left out.
+
+    Returns:
+        A tuple of the timestamps, both None if no event has one.
+    """
+    timestamps = [event["timestamp"] for event in events
+            if event.get("timestamp") is not None]
+    if not timestamps:
+        return None, None
+    return min(timestamps), max(timestamps)
+
+def _add_to_analytics(connection, userid, position):
+    """Adds a newly finished task to the analytics of its id and view.
+
+    Its time is kept in the elapsed column, from which get_analytics() reads
+    the medians, so finishing a task doesn't touch the other tasks.
+    """
+    connection.execute("""UPDATE tasks SET elapsed = %s WHERE userid = ? AND
+        position = ?""" % TIME_ELAPSED_SQL, (userid, position))
+    task_id, view, success, clicks, time_elapsed = connection.execute(
+            """SELECT id, view, %s, clicks, elapsed FROM tasks WHERE
+            userid = ? AND position = ?""" % SUCCESS_SQL,
+            (userid, position)).fetchone()
+
+    for grouping, key in (("task", task_id), ("view", view)):
+        connection.execute("""INSERT OR IGNORE INTO analytics (grouping, key)
+            VALUES (?, ?)""", (grouping, str(key)))
+        connection.execute("""UPDATE analytics SET completed = completed + 1,
+            successes = successes + ?, clicks = clicks + ?,
+            total_time = total_time + ? WHERE grouping = ? AND key = ?""",
+            (success, clicks, time_elapsed, grouping, str(key)))
 
 def get_all_users():
-    users = []
-    for n in os.listdir("user_data"):
-        # Ignore README.md and other files
-        if not n.endswith(".db"):
+    connection = get_connection()
+    return [_load_user(connection, userid, current_task) for userid,
+            current_task in connection.execute("""SELECT userid, current_task
+                FROM users ORDER BY userid""").fetchall()]
+
+def iter_tasks(task_id=None, view=None, since=None, until=None):
+    """Yields (userid, position, task) tuples, one database row at a time.
+
+    Args:
+        task_id: Only yield tasks with this id.
+        view: Only yield tasks of this view, e.g. "navigation".
+        since: Only yield tasks last updated at or after this Unix time.
+        until: Only yield tasks last updated before this Unix time.
+    """
+    conditions = []
+    parameters = []
+    for condition, value in (("id = ?", task_id), ("view = ?", view),
+            ("updated >= ?", since), ("updated < ?", until)):
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+
+    get_connection() # creates the tables if needed
+
+    # A separate connection, so the cursor can stay open while the caller
+    # saves users
+    connection = sqlite3.connect(DATABASE, timeout=30)
+    try:
+        cursor = connection.execute("""SELECT userid, position, %s FROM tasks
+            %s ORDER BY userid, position""" % (TASK_COLUMNS,
+                "WHERE " + " AND ".join(conditions) if conditions else ""),
+            parameters)
+        for row in cursor:
+            yield row[0], row[1], _load_task(row[2:])
+    finally:
+        connection.close()
+
+def migrate_pickles(directory="user_data"):
+    """Copies users from the old per-user pickle files into the database.
+
+    Users that are already in the database are skipped, so it's safe to run
+    this more than once.
+
+    Returns:
+        The number of users copied.
+    """
+    connection = get_connection()
+    migrated = 0
+    for n in sorted(os.listdir(directory)):
+        if not (n.startswith("data_") and n.endswith(".db")):
             continue
-        with open(os.path.join("user_data", n), "rb+") as f:
-            users.append(pickle.load(f))
-    return users
+        with open(os.path.join(directory, n), "rb") as f:
+            user = pickle.load(f)
+        if connection.execute("SELECT 1 FROM users WHERE userid = ?",
+                (user.userid,)).fetchone() is not None:
+            continue
+        # Old pickles don't track completions, so their finished tasks are
+        # counted in the analytics like newly finished ones
+        user._completed = [position for position, task in
+                enumerate(user.tasks) if task.finished]
+        save_user_data(user)
+        migrated += 1
+    get_event_log().flush()
+    return migrated
 
 def get_test_tasks(userid):
     tasks = [
@@ -205,10 +502,23 @@ class Task:
         self.text = text
         self.link = link
         self.view = view
+        # Events appended since the task was loaded
         self.stats = []
         self.link_found = None
         self.active = False
         self.finished = False
+        # Running totals of all the task's events
+        self.clicks = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # Unix time of the last change written to the database
+        self.updated = None
+        # What has been written to the database
+        self._saved_state = None
+        self._saved_stats = 0
+
+    def _state(self):
+        return (self.link_found, int(self.active), int(self.finished))
     
     def get_id(self):
         return str(self.id)
@@ -224,18 +534,27 @@ class Task:
         return str(self.finished)
 
     def append_stats(self, stats):
+        if not stats:
+            return
         self.stats.extend(stats)
+        self.clicks += len(stats)
+        first, last = event_time_range(stats)
+        if first is not None:
+            self.first_timestamp = first if self.first_timestamp is None \
+                    else min(self.first_timestamp, first)
+            self.last_timestamp = last if self.last_timestamp is None \
+                    else max(self.last_timestamp, last)
 
     def time_elapsed(self):
-        if len(self.stats) < 2:
+        if self.clicks < 2 or self.first_timestamp is None:
             return "0"
-        return str(self.stats[-1]["timestamp"] - self.stats[0]["timestamp"])
+        return str(self.last_timestamp - self.first_timestamp)
 
     def success(self):
         return str(self.link == self.link_found)
 
     def number_of_clicks(self):
-        return str(len(self.stats))
+        return str(self.clicks)
 
 class UserData:
     def __init__(self, userid):
@@ -243,6 +562,9 @@ class UserData:
         self.tasks = get_test_tasks(userid)
         self.tasks[0].active = True
         self.current_task = 0
+        self._saved_current_task = None
+        # Positions of the tasks finished since the last save
+        self._completed = []
 
     def get_task(self):
         return self.tasks[self.current_task]
@@ -253,9 +575,23 @@ class UserData:
     def end_task(self):
         task = self.tasks[self.current_task]
         task.complete()
+        # Added to the analytics by save_user_data()
+        self._completed.append(self.current_task)
         self.current_task += 1
         try:
             task = self.tasks[self.current_task]
             task.start()
         except:
             pass
+
+def main():
+    p = argparse.ArgumentParser(description="Manages the user data store.")
+    p.add_argument("--migrate", default=False, action="store_true",
+        help="Copy users from the old pickle files into %s." % DATABASE)
+    opts = p.parse_args()
+
+    if opts.migrate:
+        print("Migrated %d users to %s" % (migrate_pickles(), DATABASE))
+
+if __name__ == "__main__":
+    main()